@@ -0,0 +1,169 @@
+"""An asyncio API for running test cases, for embedding the test harness in a long-running service"""
+
+import asyncio
+import os
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from runner import DEFAULT_EXCLUDED_DEPENDENCIES, Outcome, ResourceGuard, ignored_testcases, select_testcases, \
+    init_worker, run_batch
+from test_harness import Catalog, CatalogIndex, source_cache
+
+
+class AsyncHarness(object):
+    """Runs test cases of a catalog in a pool of worker processes, for asyncio code
+
+    The catalog is read once, here and in every worker; the workers are kept between
+    selections, so their testsets, source documents and parsers stay warm.
+    Test cases are run within the limits of the given ResourceGuard, and with the
+    given verbosity (the output of a test case is in the output of its Outcome).
+    A test case that kills its worker process is reported as crashed, and the
+    workers are started again.
+    At most max_pending test cases of a selection are queued or running at a time;
+    the next ones are only started as the outcomes are consumed.
+
+        async with AsyncHarness("catalog.xml", jobs=4) as harness:
+            async for outcome in harness.run_selection("fn-abs"):
+                print(outcome.name, outcome.status)
+    """
+
+    def __init__(self, catalog_file, jobs=None, verbose=0, guard=None, index_path=None,
+                 excluded=DEFAULT_EXCLUDED_DEPENDENCIES, max_pending=None):
+        self.catalog_file = os.path.abspath(catalog_file)
+        self.jobs = jobs or os.cpu_count()
+        self.verbose = verbose
+        self.guard = guard if guard is not None else ResourceGuard()
+        self.index_path = os.path.abspath(index_path) if index_path else None
+        self.excluded = set(excluded)
+        self.max_pending = max_pending or 2 * self.jobs
+        self.catalog = None
+        self.executor = None
+        # the testsets are read (and stored in the index) when they are first
+        # selected, outside of the event loop, so only one selection is made at a time
+        self.lock = asyncio.Lock()
+
+    async def start(self):
+        """Reads the catalog and starts the worker processes (if that was not done yet)"""
+        async with self.lock:
+            if self.executor is not None:
+                return
+            loop = asyncio.get_running_loop()
+            self.catalog = await loop.run_in_executor(None, self._read_catalog)
+            self.executor = self._start_workers(self.jobs)
+
+    def _read_catalog(self):
+        index = CatalogIndex(self.index_path) if self.index_path else None
+        return Catalog(self.catalog_file, index)
+
+    def _start_workers(self, jobs):
+        return ProcessPoolExecutor(
+            max_workers=jobs, initializer=init_worker,
+            initargs=(self.catalog_file, self.verbose, self.guard, source_cache.maxsize, self.index_path))
+
+    def _replace_workers(self, broken):
+        """Starts a new pool of workers in place of a broken one (unless that was done already)"""
+        if self.executor is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.executor = self._start_workers(self.jobs)
+
+    def _submit(self, loop, batch):
+        """Returns the pending entry of a batch, submitted to the pool of workers
+
+        A worker that died while the pool was idle only shows when the next batch is
+        submitted; the batch is then submitted to a new pool.
+        """
+        executor = self.executor
+        try:
+            return batch, executor, loop.run_in_executor(executor, run_batch, batch)
+        except BrokenProcessPool:
+            self._replace_workers(executor)
+            return batch, self.executor, loop.run_in_executor(self.executor, run_batch, batch)
+
+    async def _recover(self, broken, batch):
+        """Returns the outcome of a batch whose worker pool broke, and replaces that pool
+
+        A worker process that dies breaks all the test cases running in its pool, so the
+        batch is run again in a worker of its own; it crashed if it kills that one too.
+        """
+        self._replace_workers(broken)
+        loop = asyncio.get_running_loop()
+        executor = self._start_workers(1)
+        try:
+            return (await loop.run_in_executor(executor, run_batch, batch))[0]
+        except BrokenProcessPool:
+            testset_name, (name,) = batch
+            return Outcome(name, "crashed", testset=testset_name, error="the worker process died")
+        finally:
+            executor.shutdown(wait=False)
+
+    async def close(self):
+        """Stops the worker processes; test cases that did not start yet are cancelled"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        if self.catalog is not None and self.catalog.index is not None:
+            self.catalog.index.close()
+            self.catalog = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def select(self, test_name=None):
+        """Returns the plan for the test cases whose name contains test_name (see runner.run_plan)"""
+        selected = select_testcases(self.catalog, test_name)
+        ignored = ignored_testcases(selected, self.excluded)
+        plan = []
+        for ts, tc in selected:
+            if tc.name in ignored:
+                plan.append((ts, Outcome(tc.name, "ignored", testset=ts.name)))
+            else:
+                plan.append((ts, tc))
+        if self.catalog.index is not None:
+            self.catalog.index.commit()
+        return plan
+
+    async def run_selection(self, test_name=None):
+        """Yields the Outcome of every test case whose name contains test_name, in catalog order
+
+        When the iteration is stopped or cancelled, the test cases of the selection that
+        did not start yet are cancelled.
+        """
+        await self.start()
+        loop = asyncio.get_running_loop()
+        # reading the testset files is done outside of the event loop as well
+        async with self.lock:
+            plan = iter(await loop.run_in_executor(None, self.select, test_name))
+        pending = deque()
+        try:
+            while True:
+                while len(pending) < self.max_pending:
+                    entry = next(plan, None)
+                    if entry is None:
+                        break
+                    testset, item = entry
+                    if isinstance(item, Outcome):
+                        pending.append(item)
+                    else:
+                        pending.append(self._submit(loop, (testset.name, [item.name])))
+                if not pending:
+                    break
+                item = pending.popleft()
+                if isinstance(item, Outcome):
+                    yield item
+                    continue
+                batch, executor, future = item
+                try:
+                    outcome = (await future)[0]
+                except BrokenProcessPool:
+                    outcome = await self._recover(executor, batch)
+                yield outcome
+        finally:
+            for item in pending:
+                if not isinstance(item, Outcome):
+                    item[2].cancel()
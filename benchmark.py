@@ -0,0 +1,173 @@
+"""Runs the test statements repeatedly, to measure how fast elementpath parses and evaluates them"""
+
+import math
+import time
+
+from collections import OrderedDict
+
+from runner import Outcome, ResourceGuard
+from test_harness import TestContext, TestTimeout, ResourceExceeded, context_document, context_factory, \
+    get_parser
+
+
+# The operations that are timed separately for every run of a test statement
+OPERATIONS = ["parse", "evaluate"]
+
+# The percentiles of the operation times that are reported
+PERCENTILES = [50, 90, 99]
+
+
+class Timings(object):
+    """The times in seconds of a series of runs of one operation"""
+
+    def __init__(self):
+        self.values = []
+
+    def add(self, value):
+        self.values.append(value)
+
+    def extend(self, other):
+        self.values.extend(other.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def total(self):
+        return sum(self.values)
+
+    def ops_per_second(self):
+        total = self.total()
+        return len(self.values) / total if total > 0 else 0.0
+
+    def mean(self):
+        return self.total() / len(self.values) if self.values else 0.0
+
+    def variance(self):
+        if len(self.values) < 2:
+            return 0.0
+        mean = self.mean()
+        return sum((value - mean) ** 2 for value in self.values) / (len(self.values) - 1)
+
+    def percentile(self, percent):
+        """Returns the given percentile, with the nearest-rank method"""
+        if not self.values:
+            return 0.0
+        values = sorted(self.values)
+        rank = max(int(math.ceil(percent / 100.0 * len(values))) - 1, 0)
+        return values[rank]
+
+    def as_dict(self):
+        result = OrderedDict()
+        result["count"] = len(self.values)
+        result["ops_per_second"] = self.ops_per_second()
+        result["mean"] = self.mean()
+        result["variance"] = self.variance()
+        for percent in PERCENTILES:
+            result["p%d" % percent] = self.percentile(percent)
+        return result
+
+
+class Benchmark(object):
+    """Runs test statements warmup + iterations times, and collects the times of the iterations per testset
+
+    Test statements that can't be parsed or evaluated are not benchmarked; they are
+    counted as failed. The guard limits apply to all runs of a test statement together.
+    """
+
+    def __init__(self, warmup=3, iterations=10, guard=None, verbose=1):
+        self.warmup = warmup
+        self.iterations = iterations
+        self.guard = guard if guard is not None else ResourceGuard()
+        self.verbose = verbose
+        self.testsets = OrderedDict()
+        self.benchmarked = 0
+        self.failed = 0
+        self.interrupted = 0
+
+    def run(self, catalog, plan):
+        """Benchmarks the test cases of a plan (precomputed outcomes are left out)"""
+        for testset, item in plan:
+            if isinstance(item, Outcome):
+                continue
+            test_context = TestContext(catalog.environments, testset, item, self.verbose)
+            self.run_testcase(test_context)
+
+    def run_testcase(self, test_context):
+        tc = test_context.testcase
+        parser = get_parser()
+        timings = OrderedDict((operation, Timings()) for operation in OPERATIONS)
+        try:
+            with self.guard:
+                document = context_document(test_context)
+                for iteration in range(self.warmup + self.iterations):
+                    start = time.perf_counter()
+                    root_node = parser.parse(tc.test)
+                    parsed = time.perf_counter()
+                    root_node.evaluate(context_factory.create(document))
+                    evaluated = time.perf_counter()
+                    if iteration >= self.warmup:
+                        timings["parse"].add(parsed - start)
+                        timings["evaluate"].add(evaluated - parsed)
+        except (TestTimeout, ResourceExceeded) as interruption:
+            if self.verbose >= 2:
+                print("benchmark of %s interrupted: %s" % (tc.name, type(interruption).__name__))
+            self.interrupted += 1
+            return
+        except Exception as exc:
+            if self.verbose >= 3:
+                print("not benchmarking %s: %s" % (tc.name, str(exc)))
+            self.failed += 1
+            return
+
+        self.benchmarked += 1
+        testset_timings = self.testsets.setdefault(test_context.testset.name, OrderedDict(
+            [("testcases", 0)] + [(operation, Timings()) for operation in OPERATIONS]))
+        testset_timings["testcases"] += 1
+        for operation in OPERATIONS:
+            testset_timings[operation].extend(timings[operation])
+
+    def totals(self):
+        totals = OrderedDict((operation, Timings()) for operation in OPERATIONS)
+        for testset_timings in self.testsets.values():
+            for operation in OPERATIONS:
+                totals[operation].extend(testset_timings[operation])
+        return totals
+
+    def print_summary(self):
+        print("%d testcases benchmarked (%d warm-up runs, %d timed runs each)" %
+              (self.benchmarked, self.warmup, self.iterations))
+        print("%d testcases could not be run" % self.failed)
+        print("%d testcases exceeded the time or memory limit" % self.interrupted)
+        print("")
+
+        header = "%-40s %-8s %12s" + " %10s" * (len(PERCENTILES) + 1)
+        print(header % (("testset", "", "ops/sec") + tuple("p%d (us)" % p for p in PERCENTILES) + ("stdev (us)",)))
+        rows = list(self.testsets.items()) + [("total", self.totals())]
+        for name, timings in rows:
+            for operation in OPERATIONS:
+                print(self._row(name, operation, timings[operation]))
+                name = ""
+
+    @staticmethod
+    def _row(name, operation, timings):
+        columns = [timings.percentile(percent) * 1e6 for percent in PERCENTILES]
+        columns.append(math.sqrt(timings.variance()) * 1e6)
+        return ("%-40s %-8s %12.1f" % (name, operation, timings.ops_per_second()) +
+                "".join(" %10.1f" % column for column in columns))
+
+    def as_dict(self):
+        result = OrderedDict()
+        result["warmup"] = self.warmup
+        result["iterations"] = self.iterations
+        result["benchmarked"] = self.benchmarked
+        result["failed"] = self.failed
+        result["interrupted"] = self.interrupted
+        result["testsets"] = OrderedDict()
+        for name, timings in self.testsets.items():
+            testset_result = OrderedDict([("testcases", timings["testcases"])])
+            for operation in OPERATIONS:
+                testset_result[operation] = timings[operation].as_dict()
+            result["testsets"][name] = testset_result
+        result["total"] = OrderedDict((operation, timings.as_dict())
+                                      for operation, timings in self.totals().items())
+        return result
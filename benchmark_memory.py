@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""Measures the memory taken by the loaded catalog, testsets and test cases"""
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+from test_harness import Catalog
+from util import WorkingDirectory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', help='the file of the catalog.xml to read (the main file of the test suite)')
+    parser.add_argument('testcase', nargs='?', help='only load the testsets that match this name')
+    parser.add_argument('--top', type=int, default=0, metavar='N', help='also print the N source lines that allocated the most memory')
+    args = parser.parse_args()
+
+    full_path = os.path.abspath(args.filename)
+    if not os.path.exists(full_path):
+        print("Error: %s does not exist" % args.filename)
+        return 1
+
+    with WorkingDirectory(os.path.dirname(full_path)):
+        gc.collect()
+        tracemalloc.start()
+        catalog = Catalog(full_path)
+        testsets = [ts for ts in catalog.testsets.values() if ts.matches(args.testcase)]
+        testcases = 0
+        for ts in testsets:
+            testcases += len(ts.testcases)
+        gc.collect()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    print("%d testsets, %d testcases loaded" % (len(testsets), testcases))
+    print("%.1f MB in use, %.1f MB at peak" % (current / 1048576.0, peak / 1048576.0))
+    if testcases:
+        print("%d bytes per testcase" % (current / testcases))
+    if args.top:
+        print("")
+        for stat in snapshot.statistics('lineno')[:args.top]:
+            print(stat)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
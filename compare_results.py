@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
+import glob
+import hashlib
 import json
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
 
 
 class WorkingDirectory(object):
@@ -19,21 +23,106 @@ class WorkingDirectory(object):
         os.chdir(self.original_directory)
 
 
-def compare_reports(report_file_a, report_file_b):
-    with open(report_file_a, 'r') as infile:
-        report_a = json.load(infile)
-    with open(report_file_b, 'r') as infile:
-        report_b = json.load(infile)
+# Default thresholds for reporting a change in the time a test takes
+DEFAULT_RATIO = 1.5
+DEFAULT_MIN_DELTA = 0.01
+DEFAULT_TOP = 20
 
+# Where reports of test suite runs are kept, by report_cache_key
+DEFAULT_CACHE_DIR = '/tmp/elementpath_reports'
+
+
+def elementpath_time(timings):
+    """The time spent in elementpath (parsing and evaluating the test statement)"""
+    return timings.get("parse", 0.0) + timings.get("evaluate", 0.0)
+
+
+def print_timing_changes(title, changes, top):
+    print("%s (%d):" % (title, len(changes)))
+    for name, old, new in changes[:top]:
+        print("    %9.4fs -> %9.4fs  %+8.1f%%  %s" % (old, new, (new - old) / old * 100 if old else 0.0, name))
+    print("")
+
+
+def compare_timing_section(report_a, report_b, section, ratio, min_delta):
+    """Compares the elementpath times of one of the timing sections of two reports
+
+    Returns the lists of regressions and improvements as (name, old, new) tuples, the
+    largest changes first; a change is significant if the time changed by more than the
+    given ratio and more than min_delta seconds.
+    """
+    timings_a = report_a[section]
+    timings_b = report_b[section]
+    regressions = []
+    improvements = []
+    for name, timings in timings_a.items():
+        if name not in timings_b:
+            continue
+        old = elementpath_time(timings)
+        new = elementpath_time(timings_b[name])
+        if new - old > min_delta and new > old * ratio:
+            regressions.append((name, old, new))
+        elif old - new > min_delta and old > new * ratio:
+            improvements.append((name, old, new))
+    regressions.sort(key=lambda change: change[1] - change[2])
+    improvements.sort(key=lambda change: change[2] - change[1])
+    return regressions, improvements
+
+
+def compare_timings(report_a, report_b, ratio=DEFAULT_RATIO, min_delta=DEFAULT_MIN_DELTA, top=DEFAULT_TOP):
+    """Prints the test cases and testsets whose elementpath time changed significantly
+
+    Returns the number of significant regressions.
+    """
+    regression_count = 0
+    for section, kind in (("timings", "testcases"), ("testset_timings", "testsets")):
+        if section not in report_a or section not in report_b:
+            continue
+        regressions, improvements = compare_timing_section(report_a, report_b, section, ratio, min_delta)
+        print_timing_changes("Performance regressions in %s" % kind, regressions, top)
+        print_timing_changes("Performance improvements in %s" % kind, improvements, top)
+        regression_count += len(regressions)
+    return regression_count
+
+
+def load_report(report_file):
+    with open(report_file, 'r') as infile:
+        return json.load(infile)
+
+
+def report_fields(*reports):
+    """Returns the statuses that are listed by name in any of the reports, in report order"""
     fields = []
-    for f in report_a["summary"].keys():
-        if f not in ['read', 'ignored', 'run', 'skipped']:
-            fields.append(f)
+    for report in reports:
+        for f in report["summary"].keys():
+            if f not in ['read', 'ignored', 'run', 'skipped'] and f not in fields:
+                fields.append(f)
+    return fields
+
+
+def status_map(report, fields):
+    """Returns a dict that maps the names of the test cases in the report to their status"""
+    statuses = {}
+    for field in fields:
+        for name in report.get(field, []):
+            statuses[name] = field
+    return statuses
+
+
+def compare_reports(report_file_a, report_file_b, ratio=DEFAULT_RATIO, min_delta=DEFAULT_MIN_DELTA, top=DEFAULT_TOP):
+    """Prints the differences between two reports
+
+    Returns the number of significant performance regressions.
+    """
+    report_a = load_report(report_file_a)
+    report_b = load_report(report_file_b)
+    fields = report_fields(report_a, report_b)
 
     print("Summary of differences:")
     for field in fields:
-        val_a = report_a["summary"][field]
-        val_b = report_b["summary"][field]
+        # older reports may not have all statuses
+        val_a = report_a["summary"].get(field, 0)
+        val_b = report_b["summary"].get(field, 0)
         diff = val_b - val_a
         if diff > 0:
             diffstr = "+%d" % diff
@@ -44,23 +133,81 @@ def compare_reports(report_file_a, report_file_b):
         print("    status %s: %s" % (field, diffstr))
     print("")
 
+    statuses_b = status_map(report_b, fields)
     move_report = {}
     for field in fields:
-        for name in report_a[field]:
-            if name not in report_b[field]:
-                # print("No longer in %s: %s" % (field, name))
-                for new_field in fields:
-                    if name in report_b[new_field]:
-                        # print("now in %s" % new_field)
-                        key = (field, new_field)
-                        if key in move_report:
-                            move_report[key].append(name)
-                        else:
-                            move_report[key] = [name]
+        for name in report_a.get(field, []):
+            new_field = statuses_b.get(name)
+            if new_field is not None and new_field != field:
+                key = (field, new_field)
+                if key in move_report:
+                    move_report[key].append(name)
+                else:
+                    move_report[key] = [name]
     for key, names in move_report.items():
         for name in names:
             print("%s was %s, is now %s" % (name, key[0], key[1]))
 
+    if "timings" in report_a and "timings" in report_b:
+        print("")
+        return compare_timings(report_a, report_b, ratio, min_delta, top)
+    return 0
+
+
+def compare_report_series(report_files, json_file=None):
+    """Prints the status changes over a series of reports (for instance of successive releases)
+
+    Prints the status counts of every report, the number of status transitions between
+    each pair of successive reports, and the statuses of every test case whose status
+    is not the same in all reports ('-' if it is not listed in a report). With json_file,
+    the same data is written to that file in JSON format.
+    """
+    reports = [load_report(report_file) for report_file in report_files]
+    labels = [os.path.basename(report_file) for report_file in report_files]
+    fields = report_fields(*reports)
+    maps = [status_map(report, fields) for report in reports]
+
+    names = {}
+    for statuses in maps:
+        for name in statuses:
+            names[name] = None
+
+    transitions = [{} for _ in range(len(reports) - 1)]
+    changes = {}
+    for name in names:
+        statuses = [statuses.get(name, '-') for statuses in maps]
+        for step, (old, new) in enumerate(zip(statuses, statuses[1:])):
+            if old != new:
+                transitions[step][(old, new)] = transitions[step].get((old, new), 0) + 1
+        if any(status != statuses[0] for status in statuses):
+            changes[name] = statuses
+
+    width = max(len(label) for label in labels) + 2
+    print("%-20s" % "status" + "".join(label.rjust(width) for label in labels))
+    for field in fields:
+        print("%-20s" % field + "".join(str(report["summary"].get(field, 0)).rjust(width) for report in reports))
+    print("")
+
+    for step, counts in enumerate(transitions):
+        print("Status transitions from %s to %s:" % (labels[step], labels[step + 1]))
+        for (old, new), count in sorted(counts.items(), key=lambda item: -item[1]):
+            print("    %s -> %s: %d" % (old, new, count))
+        print("")
+
+    for name, statuses in changes.items():
+        print("%s: %s" % (name, " -> ".join(statuses)))
+
+    if json_file:
+        with open(json_file, 'w') as outfile:
+            json.dump({
+                "reports": report_files,
+                "summary": {field: [report["summary"].get(field, 0) for report in reports] for field in fields},
+                "transitions": [
+                    {"%s -> %s" % key: count for key, count in counts.items()} for counts in transitions
+                ],
+                "changes": changes,
+            }, outfile, indent=2)
+
 
 def change_git_branch(path, branch):
     with WorkingDirectory(path):
@@ -75,13 +222,108 @@ def change_git_branch(path, branch):
             sys.exit(3)
 
 
-def run_testsuite(catalog_file, report_file, force):
+def git_output(path, *args):
+    """Returns the output of a git command run in path, or None if it fails"""
+    process = subprocess.Popen(['git', '-C', path] + list(args),
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    stdout, _ = process.communicate()
+    if process.returncode != 0:
+        return None
+    return stdout
+
+
+def directory_hash(path, pattern='**/*'):
+    """Returns a hash of the contents of the directory at path
+
+    For a git checkout, this is the hash of the checked out tree plus the uncommitted
+    changes; otherwise the files matching pattern are hashed.
+    """
+    digest = hashlib.sha256()
+    tree = git_output(path, 'rev-parse', 'HEAD^{tree}')
+    if tree is not None:
+        digest.update(tree)
+        digest.update(git_output(path, 'diff', 'HEAD') or b'')
+        return digest.hexdigest()
+    for filename in sorted(glob.glob(os.path.join(path, pattern), recursive=True)):
+        if os.path.isfile(filename):
+            digest.update(os.path.relpath(filename, path).encode('utf-8'))
+            with open(filename, 'rb') as infile:
+                digest.update(hashlib.sha256(infile.read()).digest())
+    return digest.hexdigest()
+
+
+def report_cache_key(catalog_file, elementpath_path):
+    """Returns the key of the report of running the test suite with the given catalog and elementpath
+
+    The key is made from the contents of the elementpath source tree, of the test suite,
+    and of the test harness itself, so a cached report is only reused when none of
+    those changed.
+    """
+    digest = hashlib.sha256()
+    digest.update(directory_hash(elementpath_path).encode('ascii'))
+    digest.update(directory_hash(os.path.dirname(os.path.abspath(catalog_file))).encode('ascii'))
+    harness_directory = os.path.dirname(os.path.abspath(__file__))
+    for filename in sorted(glob.glob(os.path.join(harness_directory, '*.py'))):
+        with open(filename, 'rb') as infile:
+            digest.update(hashlib.sha256(infile.read()).digest())
+    return digest.hexdigest()
+
+
+def cached_report_file(cache_dir, catalog_file, elementpath_path):
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, 'report_%s.json' % report_cache_key(catalog_file, elementpath_path)[:24])
+
+
+def add_git_worktree(path, branch):
+    """Creates a temporary worktree of the repository at path, with the given branch checked out
+
+    Returns the directory of the worktree.
+    """
+    directory = os.path.join(tempfile.mkdtemp(prefix='elementpath_worktree_'), 'elementpath')
+    process = subprocess.Popen(['git', '-C', path, 'worktree', 'add', '--detach', directory, branch],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        sys.stdout.write(stderr.decode('utf-8'))
+        print("Could not create a worktree for %s, aborting" % branch)
+        shutil.rmtree(os.path.dirname(directory), ignore_errors=True)
+        sys.exit(3)
+    return directory
+
+
+def remove_git_worktree(path, directory):
+    subprocess.call(['git', '-C', path, 'worktree', 'remove', '--force', directory],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    subprocess.call(['git', '-C', path, 'worktree', 'prune'],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    shutil.rmtree(os.path.dirname(directory), ignore_errors=True)
+
+
+def start_testsuite(catalog_file, report_file, force, elementpath_path=None):
+    """Starts a run of the test suite writing a report to report_file, and returns the process
+
+    Returns None if the report already exists (and force is not set). With elementpath_path,
+    the test suite is run with the elementpath package in that directory.
+    """
     if os.path.exists(report_file) and not force:
         print("%s already exists, not running test suite again" % report_file)
+        return None
+    env = None
+    if elementpath_path is not None:
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(p for p in [elementpath_path, env.get('PYTHONPATH')] if p)
+    return subprocess.Popen(['./execute_tests.py', '-v0', '-r', report_file, catalog_file],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            env=env)
+
+
+def finish_testsuite(process, report_file):
+    """Waits for a run of the test suite started with start_testsuite"""
+    if process is None:
         return
-    process = subprocess.Popen(['./execute_tests.py', '-v0', '-r', report_file, catalog_file],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
     stdout, stderr = process.communicate()
     if stdout:
         sys.stdout.write(stdout.decode('utf-8'))
@@ -93,39 +335,100 @@ def run_testsuite(catalog_file, report_file, force):
     print("Created report: %s" % report_file)
 
 
-def compare_repository_branches(catalog_file, path, old, new, force):
+def run_testsuite(catalog_file, report_file, force):
+    finish_testsuite(start_testsuite(catalog_file, report_file, force), report_file)
+
+
+def compare_repository_branches(catalog_file, path, old, new, force, cache_dir=DEFAULT_CACHE_DIR, **thresholds):
     if not os.path.exists(path) or not os.path.isdir(path):
         print("Error: %s not found or not a directory" % path)
         sys.exit(2)
-    report_file_old = '/tmp/report_%s.json' % old
-    report_file_new = '/tmp/report_%s.json' % new
     change_git_branch(path, old)
+    report_file_old = cached_report_file(cache_dir, catalog_file, path)
     run_testsuite(catalog_file, report_file_old, force)
     change_git_branch(path, new)
+    report_file_new = cached_report_file(cache_dir, catalog_file, path)
     run_testsuite(catalog_file, report_file_new, force)
-    compare_reports(report_file_old, report_file_new)
+    return compare_reports(report_file_old, report_file_new, **thresholds)
+
+
+def compare_repository_worktrees(catalog_file, path, old, new, force, cache_dir=DEFAULT_CACHE_DIR, **thresholds):
+    """Like compare_repository_branches, but runs the test suite for both branches at the same time
+
+    Each branch is checked out in a temporary git worktree, so the checkout at path is not
+    changed; the worktrees are removed afterwards.
+    """
+    if not os.path.exists(path) or not os.path.isdir(path):
+        print("Error: %s not found or not a directory" % path)
+        sys.exit(2)
+    worktrees = []
+    try:
+        worktrees.append(add_git_worktree(path, old))
+        worktrees.append(add_git_worktree(path, new))
+        report_file_old = cached_report_file(cache_dir, catalog_file, worktrees[0])
+        report_file_new = cached_report_file(cache_dir, catalog_file, worktrees[1])
+        process_old = start_testsuite(catalog_file, report_file_old, force, worktrees[0])
+        if report_file_new == report_file_old:
+            # both branches have the same tree, so one run makes the report for both
+            finish_testsuite(process_old, report_file_old)
+        else:
+            process_new = start_testsuite(catalog_file, report_file_new, force, worktrees[1])
+            finish_testsuite(process_old, report_file_old)
+            finish_testsuite(process_new, report_file_new)
+    finally:
+        for directory in worktrees:
+            remove_git_worktree(path, directory)
+    return compare_reports(report_file_old, report_file_new, **thresholds)
 
 
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('old', help='The old branch or report')
     parser.add_argument('new', help='The new branch or report')
+    parser.add_argument('more', nargs='*', help='Later reports (with -r), to compare a series of reports')
     parser.add_argument('-c', '--catalog-file', help='the file of the catalog.xml to read (the main file of the test suite), defaults to ../qt3tests/catalog.xml', default='../qt3tests/catalog.xml')
     parser.add_argument('-g', '--git-repository', help='path of the repository (old and new are now branch names)')
     parser.add_argument('-r', '--reports', action="store_true", help='path of the repository (old and new are now report file names)')
+    parser.add_argument('-w', '--worktrees', action="store_true", help='with -g, run the test suite for both branches at the same time,\nin temporary git worktrees (this leaves the repository checkout alone)')
     parser.add_argument('-f', '--force', action="store_true", help='force running of test suite if report file already exists')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='the directory to keep the reports of test suite runs in (default %(default)s)')
+    parser.add_argument('--ratio', type=float, default=DEFAULT_RATIO, help='report test cases whose time changed by more than this ratio (default %(default)s)')
+    parser.add_argument('--min-delta', type=float, default=DEFAULT_MIN_DELTA, help='and by more than this number of seconds (default %(default)s)')
+    parser.add_argument('--json', help='write the status changes over a series of reports to the given file (JSON format)')
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP, help='the number of performance changes to list (default %(default)s)')
+    parser.epilog = """
+If both reports contain timings, the time spent in elementpath (parsing and evaluating
+the test statements) is compared as well. The exit code is 5 if any test case or
+testset got significantly slower.
+"""
     args = parser.parse_args()
 
+    thresholds = {'ratio': args.ratio, 'min_delta': args.min_delta, 'top': args.top}
     if args.reports:
         if args.git_repository:
             print("You can only specify -g or -r, not both")
             sys.exit(1)
-        compare_reports(args.old, args.new)
+        if args.more or args.json:
+            compare_report_series([args.old, args.new] + args.more, args.json)
+            return 0
+        regressions = compare_reports(args.old, args.new, **thresholds)
     elif args.git_repository:
-        compare_repository_branches(args.catalog_file, args.git_repository, args.old, args.new, args.force)
+        if args.more:
+            print("Comparing more than two branches is not supported, use -r with report files")
+            sys.exit(1)
+        if args.worktrees:
+            compare = compare_repository_worktrees
+        else:
+            compare = compare_repository_branches
+        regressions = compare(args.catalog_file, args.git_repository, args.old, args.new, args.force,
+                              cache_dir=args.cache_dir, **thresholds)
     else:
         print("You must specify either -g or -r")
+        return 1
+    if regressions:
+        return 5
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -2,25 +2,35 @@
 
 import argparse
 import json
+import shutil
 import sys
-import traceback
-
-from collections import OrderedDict
-from lxml import etree
+import tempfile
 
 from test_harness import *
+from benchmark import Benchmark
+from runner import DEFAULT_EXCLUDED_DEPENDENCIES, Outcome, PreviousReport, Report, ResourceGuard, TestProfiler, \
+    ignored_testcases, run_plan, select_shard, select_testcases
+from reports import OutcomeStream, read_stream
 from util import WorkingDirectory
 
 
+def parse_dependencies(value):
+    """Parses a TYPE=VALUE[,VALUE...] argument into a list of (type, value) tuples"""
+    dep_type, separator, values = value.partition('=')
+    if not separator or not dep_type or not values:
+        raise argparse.ArgumentTypeError("dependencies must be given as TYPE=VALUE[,VALUE...], e.g. spec=XP30,XP30+")
+    return [(dep_type, single_value) for single_value in values.split(',')]
+
 
-SKIP_TESTS = [
-    'fn-subsequence.cbcl-subsequence-010',
-    'fn-subsequence.cbcl-subsequence-011',
-    'fn-subsequence.cbcl-subsequence-012',
-    'fn-subsequence.cbcl-subsequence-013',
-    'fn-subsequence.cbcl-subsequence-014',
-    'prod-NameTest.NodeTest004'
-]
+def parse_shard(value):
+    """Parses a K/N shard argument into a (K, N) tuple"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be given as K/N, e.g. 1/4")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard K/N needs 1 <= K <= N")
+    return index, count
 
 
 def main():
@@ -28,7 +38,30 @@ def main():
     parser.add_argument('filename', help='the file of the catalog.xml to read (the main file of the test suite)')
     parser.add_argument('testcase', nargs='?', help='a specific testset or testcase to run (match on substring of testset + testcase name)')
     parser.add_argument('-r', '--report', help="Write a report (JSON format) to the given file")
+    parser.add_argument('-s', '--stream', help="Write the outcome of every test case to the given file as soon as it is known,\none JSON object per line (see reports.py fold)")
+    parser.add_argument('--resume', action='store_true', help="with -s, continue an interrupted run: the test cases that are already in\nthe stream are not run again")
+    parser.add_argument('--isolate', action='store_true', help="run the test cases in supervised worker processes (-j of them), so that a\ntest case that crashes or hangs a worker gets the status crashed instead of\nending the run")
+    parser.add_argument('--hang-timeout', type=float, metavar='SECONDS', help="with --isolate, the time after which a worker that doesn't respond is\nconsidered to hang (default: 30 seconds more than -t, or 600 seconds with -t 0)")
     parser.add_argument('-v', '--verbose', type=int, default=1, help='verbosity')
+    parser.add_argument('--top-slow', type=int, metavar='N', help='print the N slowest testcases and testsets')
+    parser.add_argument('-t', '--timeout', type=float, default=60, help='the maximum time in seconds a single test case may take (0: no limit)')
+    parser.add_argument('-m', '--memory-limit', type=int, default=2048, help='the maximum memory in MB a single test case may allocate (0: no limit)')
+    parser.add_argument('--source-cache-size', type=int, default=256, help='the maximum number of parsed source documents (and their evaluation\ncontexts) to keep in memory')
+    parser.add_argument('-i', '--index', help='keep an index of the parsed testset files in the given file, so that\nlater runs only need to read the testset files that changed')
+    parser.add_argument('--since', metavar='REPORT', help='only run the test cases that changed since the given report was made, and\ncarry the outcomes of the other test cases forward from that report')
+    parser.add_argument('--only-status', metavar='STATUSES', help='with --since, also run the test cases that had one of these (comma-separated)\nstatuses in that report, e.g. failed,parse_error')
+    parser.add_argument('--exclude', type=parse_dependencies, action='append', default=[], metavar='TYPE=VALUES',
+                        help='also ignore test cases with any of these dependencies, e.g. feature=namespace-axis')
+    parser.add_argument('--include', type=parse_dependencies, action='append', default=[], metavar='TYPE=VALUES',
+                        help='no longer ignore test cases with these dependencies by default, e.g. spec=XP30,XP30+')
+    parser.add_argument('--shard', type=parse_shard, metavar='K/N', help='only run the K-th of N parts of the selected test cases (see reports.py merge)')
+    parser.add_argument('--shard-timings', metavar='REPORT', help='with --shard, balance the parts by the timings in the given report\n(by default, all parts get the same number of test cases)')
+    parser.add_argument('--benchmark', action='store_true', help='instead of checking the results, run every selected test statement\nrepeatedly, and print how fast elementpath parses and evaluates them')
+    parser.add_argument('--warmup', type=int, default=3, help='with --benchmark, the number of untimed runs of every test statement')
+    parser.add_argument('--iterations', type=int, default=10, help='with --benchmark, the number of timed runs of every test statement')
+    parser.add_argument('--profile', action='store_true', help='profile the selected test cases with cProfile, and print the functions\nthat took the most time over all of them')
+    parser.add_argument('--profile-out', metavar='DIR', help='profile the selected test cases, and write the profile of every test case\nto DIR/<testcase name>.pstats, and the combined profile to DIR/%s' % TestProfiler.AGGREGATE_FILE)
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes to run the tests in (0: one per CPU)')
     parser.epilog = """
 Verbosity levels:\n
 0: no output
@@ -41,171 +74,139 @@ Verbosity levels:\n
     args = parser.parse_args()
 
     test_name = args.testcase
-
-    report = OrderedDict()
-    report["parse_error"] = []
-    report["evaluate_error"] = []
-    report["execute_error"] = []
-    report["testcode_error"] = []
-    report["success"] = []
-    report["failed"] = []
+    if args.only_status and not args.since:
+        print("Error: --only-status can only be used with --since")
+        sys.exit(1)
+    if args.resume and not args.stream:
+        print("Error: --resume can only be used with -s")
+        sys.exit(1)
+    if args.benchmark and (args.stream or args.since or args.isolate or args.profile or args.profile_out):
+        print("Error: --benchmark can not be used with -s, --since, --isolate, --profile or --profile-out")
+        sys.exit(1)
+    previous = PreviousReport(args.since) if args.since else None
+    shard = args.shard
+    excluded = set(DEFAULT_EXCLUDED_DEPENDENCIES)
+    for dependencies in args.exclude:
+        excluded.update(dependencies)
+    for dependencies in args.include:
+        excluded.difference_update(dependencies)
+    shard_timings = PreviousReport(args.shard_timings).timings if args.shard_timings else None
+    rerun_statuses = set(args.only_status.split(',')) if args.only_status else set()
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    source_cache.maxsize = args.source_cache_size
+    context_factory.maxsize = args.source_cache_size
+
+    profiler = None
+    if args.profile_out:
+        os.makedirs(args.profile_out, exist_ok=True)
+        profiler = TestProfiler(os.path.abspath(args.profile_out))
+    elif args.profile:
+        profiler = TestProfiler(tempfile.mkdtemp(prefix="elementpath_profile_"))
 
     full_path = os.path.abspath(args.filename)
     if not os.path.exists(full_path):
         print("Error: %s does not exist" % args.filename)
         sys.exit(1)
     directory = os.path.dirname(full_path)
-    filename = os.path.basename(full_path)
+    index = CatalogIndex(os.path.abspath(args.index)) if args.index else None
     with WorkingDirectory(directory):
-        catalog_xml = etree.parse(filename)
-
-        environments = {}
-        testsets = {}
-
-        for environment_xml in catalog_xml.getroot().findall("environment", namespaces=nsmap):
-            environment = Environment(environment_xml)
-            environments[environment.name] = environment
-
-        for testset_xml in catalog_xml.getroot().findall("test-set", namespaces=nsmap):
-            testset = TestSet(testset_xml)
-            testsets[testset.name] = testset
-
-        count_all = 0
-        count_ignore = 0
-        count = 0
-        count_true = 0
-        count_false = 0
-        count_none = 0
-        count_parse_error = 0
-        count_evaluate_error = 0
-        count_other_execution_error = 0
-        other_failure = 0
-        for ts in testsets.values():
-            # ignore test cases for XQuery, and 3.0
-            ignore_all_in_testset = False
-            if ts.spec_dependencies:
-                if ('XQ10' in ts.spec_dependencies or
-                        'XQ10+' in ts.spec_dependencies or
-                        'XP30' in ts.spec_dependencies or
-                        'XP30+' in ts.spec_dependencies or
-                        'XQ30' in ts.spec_dependencies or
-                        'XQ30+' in ts.spec_dependencies or
-                        'XP31' in ts.spec_dependencies or
-                        'XP31+' in ts.spec_dependencies or
-                        'XQ31' in ts.spec_dependencies or
-                        'XQ31+' in ts.spec_dependencies
-                ):
-                    ignore_all_in_testset = True
-            for tc in ts.testcases:
-                if test_name is None or test_name in tc.name:
-                    count_all += 1
-                    if ignore_all_in_testset:
-                        count_ignore += 1
-                        continue
-                    # ignore test cases for XQuery, and 3.0
-                    if tc.spec_dependencies:
-                        if ('XQ10' in tc.spec_dependencies or
-                                'XQ10+' in tc.spec_dependencies or
-                                'XP30' in tc.spec_dependencies or
-                                'XP30+' in tc.spec_dependencies or
-                                'XQ30' in tc.spec_dependencies or
-                                'XQ30+' in tc.spec_dependencies or
-                                'XP31' in tc.spec_dependencies or
-                                'XQ31' in tc.spec_dependencies or
-                                'XQ31+' in tc.spec_dependencies
-                        ):
-                            count_ignore += 1
-                            continue
-                        # print("DEPS: " + str(tc.spec_dependencies))
-                    # ignore tests that rely on higher-order function such as array:sort()
-                    if tc.feature_dependencies:
-                        if 'higherOrderFunctions' in tc.feature_dependencies:
-                            count_ignore += 1
-                            continue
-                    if tc.name in SKIP_TESTS:
-                        count_none += 1
-                        continue
-                    test_context = TestContext(environments, ts, tc, verbose=args.verbose)
-                    try:
-                        result = tc.run(test_context)
-                        if result is None:
-                            count_none += 1
-                        if result is False:
-                            if args.report:
-                                report["failed"].append(tc.name)
-                            count_false += 1
-                        if result is True:
-                            if args.report:
-                                report["success"].append(tc.name)
-                            count_true += 1
-                        count += 1
-                    except ParseError as parseError:
-                        if args.verbose >= 2:
-                            print("failure in parsing test statement for test " + tc.name)
-                            print("%s: %s" % (str(type(parseError)), str(parseError)))
-                        if args.verbose >= 5:
-                            traceback.print_exc()
-                        if args.report:
-                            report["parse_error"].append(tc.name)
-                        count_parse_error += 1
-                    except EvaluateError as evalError:
-                        if args.verbose >= 2:
-                            print("failure in evaluating test statement for test " + tc.name)
-                            print("%s: %s" % (str(type(evalError)), str(evalError)))
-                        if args.verbose >= 5:
-                            traceback.print_exc()
-                        if args.report:
-                            report["evaluate_error"].append(tc.name)
-                        count_evaluate_error += 1
-                    except ExecutionError as execError:
-                        if str(execError) == "Unimplemented assert_permutation":
-                            count_skipped += 1
-                        else:
-                            if args.verbose >= 2:
-                                print("failure in executing testcase for test " + tc.name)
-                                print("%s: %s" % (str(type(execError)), str(execError)))
-                            if args.verbose >= 5:
-                                traceback.print_exc()
-                            if args.report:
-                                report["execute_error"].append(tc.name)
-                            count_other_execution_error += 1
-                    except Exception as exc2:
-                        if args.verbose >= 0:
-                            print("failure in test code for test " + tc.name)
-                            print("%s: %s" % (str(type(exc2)), str(exc2)))
-                        if args.verbose >= 5:
-                            traceback.print_exc()
-                        if args.report:
-                            report["testcode_error"].append(tc.name)
-                        other_failure += 1
+        catalog = Catalog(full_path, index)
+        resumed = {}
+        if args.resume and os.path.exists(args.stream):
+            resumed = read_stream(args.stream)
+        stream = OutcomeStream(args.stream, append=args.resume) if args.stream else None
+
+        report = Report()
+        plan = []
+        carried = 0
+        resumed_count = 0
+
+        def add_outcome(testset, outcome):
+            plan.append((testset, outcome))
+            if stream is not None and outcome.name not in resumed:
+                stream.write(outcome)
+
+        selected = select_testcases(catalog, test_name)
+        changed_testsets = set()
+        for ts, tc in selected:
+            if ts.name not in report.testset_files:
+                stamp = file_stamp(ts.path)
+                report.testset_files[ts.name] = stamp
+                if previous is not None and previous.testset_changed(ts.name, stamp):
+                    changed_testsets.add(ts.name)
+        ignored = ignored_testcases(selected, excluded)
+        if shard is not None:
+            selected = select_shard(selected, shard[0], shard[1], shard_timings, ignored)
+        if stream is not None:
+            stream.write_header(report.testset_files, [tc.name for ts, tc in selected])
+
+        for ts, tc in selected:
+            if tc.name in ignored:
+                add_outcome(ts, Outcome(tc.name, "ignored", testset=ts.name))
+                continue
+            if previous is not None and ts.name not in changed_testsets:
+                # test cases that were not run before (or are new) are always run
+                outcome = previous.outcome(tc.name, ts.name)
+                if outcome is not None and outcome.status not in rerun_statuses:
+                    add_outcome(ts, outcome)
+                    carried += 1
+                    continue
+            if tc.name in resumed:
+                plan.append((ts, resumed[tc.name]))
+                resumed_count += 1
+                continue
+            plan.append((ts, tc))
+
+        if index is not None:
+            index.commit()
+
+        guard = ResourceGuard(args.timeout, args.memory_limit)
+        if args.benchmark:
+            # benchmarks are always run serially, so they don't compete for the CPU
+            benchmark = Benchmark(args.warmup, args.iterations, guard, args.verbose)
+            benchmark.run(catalog, plan)
+            if args.verbose >= 1:
+                benchmark.print_summary()
+            if args.report:
+                with open(args.report, 'w') as outfile:
+                    outfile.write(json.dumps(benchmark.as_dict(), indent=2))
+            if index is not None:
+                index.close()
+            return
+
+        for outcome in run_plan(catalog, plan, args.verbose, jobs=jobs, guard=guard,
+                                isolate=args.isolate, stream=stream, profiler=profiler,
+                                hang_timeout=args.hang_timeout):
+            report.add(outcome)
+        if stream is not None:
+            stream.close()
 
         if args.verbose >= 1:
-            print("%d testcases read" % count_all)
-            print("%d testcases ignored" % count_ignore)
-            print("%d testcases skipped" % count_none)
-            print("%d testcases run" % count)
+            report.print_summary()
+            if previous is not None:
+                print("")
+                print("%d testcases carried forward from %s" % (carried, args.since))
+            if args.resume:
+                print("%d testcases resumed from %s" % (resumed_count, args.stream))
+        if args.top_slow:
             print("")
-            print("%d errors while parsing test statement" % count_parse_error)
-            print("%d errors while evaluating test statement" % count_evaluate_error)
-            print("%d other errors while executing testcase" % count_other_execution_error)
-            print("%d errors from test code" % other_failure)
-            print("%d success" % count_true)
-            print("%d failed" % count_false)
+            report.print_slowest(args.top_slow)
+        if profiler is not None:
+            stats = profiler.aggregate([tc.name for ts, tc in plan if not isinstance(tc, Outcome)])
+            if args.profile and stats is not None:
+                print("")
+                stats.sort_stats('cumulative').print_stats(25)
+            if not args.profile_out:
+                shutil.rmtree(profiler.directory)
+        if args.verbose >= 5:
+            print("source document cache: %d hits, %d misses" % (source_cache.hits, source_cache.misses))
 
         if args.report:
-            report["summary"] = OrderedDict()
-            report["summary"]["read"] = count_all
-            report["summary"]["ignored"] = count_ignore
-            report["summary"]["skipped"] = count_none
-            report["summary"]["run"] = count
-            report["summary"]["parse_error"] = count_parse_error
-            report["summary"]["evaluate_error"] = count_evaluate_error
-            report["summary"]["execute_error"] = count_other_execution_error
-            report["summary"]["testcode_error"] = other_failure
-            report["summary"]["success"] = count_true
-            report["summary"]["failed"] = count_false
             with open(args.report, 'w') as outfile:
-                outfile.write(json.dumps(report, indent=2))
+                outfile.write(json.dumps(report.as_dict(), indent=2))
+
+    if index is not None:
+        index.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Keeps the catalog and its testsets in memory, and runs test cases on request (over a Unix socket)"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import traceback
+
+from contextlib import redirect_stdout
+
+from test_harness import Catalog, CatalogIndex, file_stamp, reload_elementpath, source_cache, context_factory
+from runner import DEFAULT_EXCLUDED_DEPENDENCIES, Outcome, Report, ResourceGuard, ignored_testcases, run_plan, \
+    select_testcases
+from util import WorkingDirectory
+
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "elementpath_harness_%d.sock" % os.getuid())
+
+
+class Daemon(object):
+    """Runs the requests of clients against a catalog that is read once
+
+    A request is a line of JSON with the testcase (name filter), verbose, report
+    (an absolute path or null) and reload_elementpath fields; everything the run
+    prints, including the summary, is sent back to the client.
+    Testsets whose file changed since they were read are read again before a run.
+    """
+
+    def __init__(self, catalog_file, guard, index=None):
+        self.directory = os.path.dirname(catalog_file)
+        self.guard = guard
+        self.index = index
+        with WorkingDirectory(self.directory):
+            self.catalog = Catalog(catalog_file, index)
+            self.stamps = {}
+            for ts in self.catalog.testsets.values():
+                ts.load()
+                self.stamps[ts.name] = file_stamp(ts.path)
+        if index is not None:
+            index.commit()
+
+    def refresh(self):
+        for ts in self.catalog.testsets.values():
+            stamp = file_stamp(ts.path)
+            if stamp != self.stamps[ts.name]:
+                ts.load()
+                self.stamps[ts.name] = stamp
+
+    def run(self, request):
+        verbose = request.get('verbose', 1)
+        if request.get('reload_elementpath'):
+            elementpath = reload_elementpath()
+            if verbose >= 1:
+                print("reloaded elementpath %s from %s" % (elementpath.__version__,
+                                                          os.path.dirname(elementpath.__file__)))
+        with WorkingDirectory(self.directory):
+            self.refresh()
+            selected = select_testcases(self.catalog, request.get('testcase'))
+            ignored = ignored_testcases(selected, DEFAULT_EXCLUDED_DEPENDENCIES)
+            report = Report()
+            plan = []
+            for ts, tc in selected:
+                report.testset_files[ts.name] = self.stamps[ts.name]
+                if tc.name in ignored:
+                    plan.append((ts, Outcome(tc.name, "ignored", testset=ts.name)))
+                else:
+                    plan.append((ts, tc))
+            for outcome in run_plan(self.catalog, plan, verbose, guard=self.guard):
+                report.add(outcome)
+        if self.index is not None:
+            self.index.commit()
+
+        if verbose >= 1:
+            report.print_summary()
+        if request.get('report'):
+            with open(request['report'], 'w') as outfile:
+                outfile.write(json.dumps(report.as_dict(), indent=2))
+
+    def handle(self, connection):
+        with connection.makefile('r') as infile, connection.makefile('w') as outfile:
+            with redirect_stdout(outfile):
+                try:
+                    self.run(json.loads(infile.readline()))
+                except Exception:
+                    traceback.print_exc(file=outfile)
+
+    def serve(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(5)
+        print("serving %d testsets of %s on %s" % (len(self.catalog.testsets), self.catalog.file, path))
+        try:
+            while True:
+                connection, address = server.accept()
+                with connection:
+                    try:
+                        self.handle(connection)
+                    except OSError:
+                        # the client went away
+                        pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.unlink(path)
+
+
+def serve(args):
+    full_path = os.path.abspath(args.filename)
+    if not os.path.exists(full_path):
+        print("Error: %s does not exist" % args.filename)
+        return 1
+    source_cache.maxsize = args.source_cache_size
+    context_factory.maxsize = args.source_cache_size
+    index = CatalogIndex(os.path.abspath(args.index)) if args.index else None
+    daemon = Daemon(full_path, ResourceGuard(args.timeout, args.memory_limit), index)
+    daemon.serve(args.socket)
+    if index is not None:
+        index.close()
+    return 0
+
+
+def run(args):
+    request = {
+        'testcase': args.testcase,
+        'verbose': args.verbose,
+        'report': os.path.abspath(args.report) if args.report else None,
+        'reload_elementpath': args.reload,
+    }
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(args.socket)
+    except OSError as exc:
+        print("Error: can't connect to the daemon at %s: %s" % (args.socket, exc))
+        return 1
+    with client:
+        client.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            sys.stdout.write(data.decode('utf-8', 'replace'))
+            sys.stdout.flush()
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    serve_parser = subparsers.add_parser('serve', help='read the catalog and run test cases for clients, until interrupted')
+    serve_parser.add_argument('filename', help='the file of the catalog.xml to read (the main file of the test suite)')
+    serve_parser.add_argument('--socket', default=DEFAULT_SOCKET, help='the Unix socket to listen on (default: %(default)s)')
+    serve_parser.add_argument('-t', '--timeout', type=float, default=60, help='the maximum time in seconds a single test case may take (0: no limit)')
+    serve_parser.add_argument('-m', '--memory-limit', type=int, default=2048, help='the maximum memory in MB a single test case may allocate (0: no limit)')
+    serve_parser.add_argument('--source-cache-size', type=int, default=256, help='the maximum number of parsed source documents (and their evaluation\ncontexts) to keep in memory')
+    serve_parser.add_argument('-i', '--index', help='keep an index of the parsed testset files in the given file (see execute_tests.py)')
+    serve_parser.set_defaults(function=serve)
+
+    run_parser = subparsers.add_parser('run', help='run test cases in the daemon, and print the output')
+    run_parser.add_argument('testcase', nargs='?', help='a specific testset or testcase to run (match on substring of testset + testcase name)')
+    run_parser.add_argument('--socket', default=DEFAULT_SOCKET, help='the Unix socket of the daemon (default: %(default)s)')
+    run_parser.add_argument('-r', '--report', help="Write a report (JSON format) to the given file")
+    run_parser.add_argument('-v', '--verbose', type=int, default=1, help='verbosity (see execute_tests.py -h)')
+    run_parser.add_argument('--reload', action='store_true', help='import elementpath again before running, to test changes to it')
+    run_parser.set_defaults(function=run)
+
+    args = parser.parse_args()
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Reading and writing streams of test case outcomes (one JSON object per line), and folding them into reports"""
+
+import argparse
+import json
+import sys
+
+from collections import OrderedDict
+
+from runner import Outcome, Report
+
+
+class OutcomeStream(object):
+    """Writes outcomes to a file as they come in, one JSON object per line
+
+    Every line is flushed right away, so the stream can be followed while the test
+    suite runs, and is complete up to the last finished test case if the run is
+    interrupted.
+    Besides outcomes, a stream has a header line per run (see write_header).
+    """
+
+    def __init__(self, filename, append=False):
+        self.filename = filename
+        self.outfile = open(filename, 'a' if append else 'w')
+
+    def write(self, outcome):
+        self.outfile.write(json.dumps(outcome.as_dict()) + "\n")
+        self.outfile.flush()
+
+    def write_header(self, testset_files, names):
+        """Writes the stamps of the testset files of a run, and the names of its test cases in run order
+
+        With these, fold_stream makes the same report as the run itself.
+        """
+        header = OrderedDict([("testset_files", testset_files), ("testcases", names)])
+        self.outfile.write(json.dumps(header) + "\n")
+        self.outfile.flush()
+
+    def close(self):
+        self.outfile.close()
+
+
+def _read_lines(filename):
+    with open(filename, 'r') as infile:
+        for line in infile:
+            try:
+                yield json.loads(line, object_pairs_hook=OrderedDict)
+            except ValueError:
+                continue
+
+
+def read_stream(filename):
+    """Returns the outcomes in a stream, by test case name
+
+    When a test case occurs more than once, the last outcome is used; a truncated last
+    line (of an interrupted run) is ignored.
+    """
+    outcomes = OrderedDict()
+    for data in _read_lines(filename):
+        if "name" not in data:
+            continue
+        outcome = Outcome.from_dict(data)
+        outcomes.pop(outcome.name, None)
+        outcomes[outcome.name] = outcome
+    return outcomes
+
+
+def fold_stream(filename):
+    """Returns the Report of all outcomes in a stream
+
+    The outcomes are added in the order of the test cases in the headers of the
+    stream (outcomes of other test cases come last), and the testset stamps of the
+    headers are copied into the report; of a resumed run, the last header counts.
+    """
+    order = OrderedDict()
+    testset_files = OrderedDict()
+    for data in _read_lines(filename):
+        if "name" not in data:
+            testset_files.update(data.get("testset_files", {}))
+            for name in data.get("testcases", []):
+                order.setdefault(name, len(order))
+
+    report = Report()
+    report.testset_files = testset_files
+    outcomes = read_stream(filename).values()
+    for outcome in sorted(outcomes, key=lambda outcome: order.get(outcome.name, len(order))):
+        report.add(outcome)
+    return report
+
+
+def merge_reports(reports):
+    """Merges reports of parts of a run (such as the shards of execute_tests.py --shard) into one report"""
+    merged = OrderedDict()
+    for report in reports:
+        for key, value in report.items():
+            if isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+            elif key == "summary":
+                summary = merged.setdefault(key, OrderedDict())
+                for field, count in value.items():
+                    summary[field] = summary.get(field, 0) + count
+            elif key == "testset_timings":
+                testset_timings = merged.setdefault(key, OrderedDict())
+                for testset, aggregate in value.items():
+                    totals = testset_timings.setdefault(testset, OrderedDict())
+                    for field, amount in aggregate.items():
+                        totals[field] = round(totals.get(field, 0) + amount, 6)
+            elif isinstance(value, dict):
+                merged.setdefault(key, OrderedDict()).update(value)
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    fold_parser = subparsers.add_parser('fold', help='print the summary of an outcome stream (written with execute_tests.py -s)')
+    fold_parser.add_argument('stream', help='the outcome stream to read')
+    fold_parser.add_argument('-r', '--report', help="Write a report (JSON format) to the given file")
+    merge_parser = subparsers.add_parser('merge', help='merge the reports of the shards of a run (execute_tests.py --shard)')
+    merge_parser.add_argument('reports', nargs='+', help='the reports to merge')
+    merge_parser.add_argument('-r', '--report', required=True, help="Write the merged report (JSON format) to the given file")
+    args = parser.parse_args()
+
+    if args.command == 'merge':
+        reports = []
+        for filename in args.reports:
+            with open(filename, 'r') as infile:
+                reports.append(json.load(infile, object_pairs_hook=OrderedDict))
+        with open(args.report, 'w') as outfile:
+            outfile.write(json.dumps(merge_reports(reports), indent=2))
+    elif args.command == 'fold':
+        report = fold_stream(args.stream)
+        report.print_summary()
+        if args.report:
+            with open(args.report, 'w') as outfile:
+                outfile.write(json.dumps(report.as_dict(), indent=2))
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
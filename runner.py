@@ -0,0 +1,717 @@
+"""Runs test cases and collects their outcomes, either serially or over a pool of worker processes"""
+
+import cProfile
+import io
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import pstats
+import re
+import signal
+import sys
+import threading
+import time
+import traceback
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, memory limits are not enforced there
+    resource = None
+
+from test_harness import Catalog, CatalogIndex, DependencyIndex, TestContext, ExecutionError, ParseError, EvaluateError, \
+    TestTimeout, ResourceExceeded, context_factory, source_cache
+
+
+# The statuses that are listed by test case name in the JSON report, in report order
+REPORT_STATUSES = [
+    "parse_error",
+    "evaluate_error",
+    "execute_error",
+    "testcode_error",
+    "success",
+    "failed",
+    "timeout",
+    "resource_exceeded",
+    "crashed",
+]
+
+# Number of test cases handed to a worker process at a time
+BATCH_SIZE = 50
+
+# Seconds on top of the timeout after which an isolated worker is considered to hang
+HANG_GRACE = 30
+
+# Seconds after which an isolated worker is considered to hang when test cases have no timeout
+DEFAULT_HANG_TIMEOUT = 600
+
+
+# The timings that are recorded for every test case that is run
+TIMINGS = ["parse", "evaluate", "assert"]
+
+# Test cases with any of these dependencies are ignored: XQuery and XPath 3.0 and
+# later, and tests that rely on higher-order functions such as array:sort()
+DEFAULT_EXCLUDED_DEPENDENCIES = [
+    ('spec', 'XQ10'),
+    ('spec', 'XQ10+'),
+    ('spec', 'XP30'),
+    ('spec', 'XP30+'),
+    ('spec', 'XQ30'),
+    ('spec', 'XQ30+'),
+    ('spec', 'XP31'),
+    ('spec', 'XP31+'),
+    ('spec', 'XQ31'),
+    ('spec', 'XQ31+'),
+    ('feature', 'higherOrderFunctions'),
+]
+
+
+class Outcome(object):
+    """The outcome of a single test case
+
+    status is one of REPORT_STATUSES, 'ignored' or 'skipped'; ran is True if the
+    test case was run to completion (this includes results that were not checked).
+    timings maps the TIMINGS to seconds, for test cases that were run.
+    error is the name of the exception class of errors in the test statement or test code.
+    output contains the text printed while running the test in a worker process.
+    """
+
+    def __init__(self, name, status, ran=False, testset=None, timings=None, error=None, output=None):
+        self.name = name
+        self.status = status
+        self.ran = ran
+        self.testset = testset
+        self.timings = timings
+        self.error = error
+        self.output = output
+
+    def as_dict(self):
+        data = OrderedDict()
+        data["name"] = self.name
+        data["testset"] = self.testset
+        data["status"] = self.status
+        data["ran"] = self.ran
+        if self.timings:
+            data["timings"] = OrderedDict((t, round(self.timings[t], 6)) for t in TIMINGS)
+        if self.error:
+            data["error"] = self.error
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        timings = data.get("timings")
+        return cls(data["name"], data["status"], ran=data.get("ran", False), testset=data.get("testset"),
+                   timings=OrderedDict(timings) if timings else None, error=data.get("error"))
+
+    @property
+    def total_time(self):
+        return sum(self.timings.values()) if self.timings else 0.0
+
+
+class Report(object):
+    """Collects outcomes into the summary counters and the per-status lists of the JSON report"""
+
+    def __init__(self):
+        self.read = 0
+        self.ran = 0
+        self.counts = OrderedDict()
+        self.counts["ignored"] = 0
+        self.counts["skipped"] = 0
+        for status in REPORT_STATUSES:
+            self.counts[status] = 0
+        self.names = OrderedDict((status, []) for status in REPORT_STATUSES)
+        self.timings = OrderedDict()
+        self.testset_timings = OrderedDict()
+        # The stamps of the testset files the outcomes are based on, by testset name
+        self.testset_files = OrderedDict()
+
+    def add(self, outcome):
+        self.read += 1
+        if outcome.ran:
+            self.ran += 1
+        self.counts[outcome.status] += 1
+        if outcome.status in self.names:
+            self.names[outcome.status].append(outcome.name)
+        if outcome.timings:
+            self.timings[outcome.name] = outcome.timings
+            if outcome.testset not in self.testset_timings:
+                self.testset_timings[outcome.testset] = OrderedDict([("count", 0)] + [(t, 0.0) for t in TIMINGS])
+            aggregate = self.testset_timings[outcome.testset]
+            aggregate["count"] += 1
+            for timing in TIMINGS:
+                aggregate[timing] += outcome.timings[timing]
+
+    def print_slowest(self, count):
+        """Prints the given number of slowest test cases and testsets"""
+        def total(timings):
+            return sum(timings[timing] for timing in TIMINGS)
+
+        def row(name, timings):
+            return "%10.4f %10.4f %10.4f %10.4f  %s" % (
+                total(timings), timings["parse"], timings["evaluate"], timings["assert"], name)
+
+        header = "%10s %10s %10s %10s  %s" % ("total", "parse", "evaluate", "assert", "%s")
+        print(header % "slowest testcases")
+        for name, timings in sorted(self.timings.items(), key=lambda item: -total(item[1]))[:count]:
+            print(row(name, timings))
+        print("")
+        print(header % "slowest testsets")
+        for name, timings in sorted(self.testset_timings.items(), key=lambda item: -total(item[1]))[:count]:
+            print(row("%s (%d testcases)" % (name, timings["count"]), timings))
+
+    def print_summary(self):
+        print("%d testcases read" % self.read)
+        print("%d testcases ignored" % self.counts["ignored"])
+        print("%d testcases skipped" % self.counts["skipped"])
+        print("%d testcases run" % self.ran)
+        print("")
+        print("%d errors while parsing test statement" % self.counts["parse_error"])
+        print("%d errors while evaluating test statement" % self.counts["evaluate_error"])
+        print("%d other errors while executing testcase" % self.counts["execute_error"])
+        print("%d errors from test code" % self.counts["testcode_error"])
+        print("%d timeouts" % self.counts["timeout"])
+        print("%d exceeded the memory limit" % self.counts["resource_exceeded"])
+        print("%d crashed" % self.counts["crashed"])
+        print("%d success" % self.counts["success"])
+        print("%d failed" % self.counts["failed"])
+
+    def as_dict(self):
+        report = OrderedDict()
+        for status, names in self.names.items():
+            report[status] = names
+        report["summary"] = OrderedDict()
+        report["summary"]["read"] = self.read
+        report["summary"]["ignored"] = self.counts["ignored"]
+        report["summary"]["skipped"] = self.counts["skipped"]
+        report["summary"]["run"] = self.ran
+        for status in REPORT_STATUSES:
+            report["summary"][status] = self.counts[status]
+        report["timings"] = OrderedDict(
+            (name, OrderedDict((t, round(timings[t], 6)) for t in TIMINGS)) for name, timings in self.timings.items()
+        )
+        report["testset_timings"] = OrderedDict(
+            (name, OrderedDict((k, round(v, 6)) for k, v in aggregate.items()))
+            for name, aggregate in self.testset_timings.items()
+        )
+        report["testset_files"] = self.testset_files
+        return report
+
+
+def select_testcases(catalog, test_name=None):
+    """Returns (testset, testcase) tuples for the test cases of the catalog whose name contains test_name"""
+    selected = []
+    for ts in catalog.testsets.values():
+        if not ts.matches(test_name):
+            continue
+        for tc in ts.testcases:
+            if test_name is None or test_name in tc.name:
+                selected.append((ts, tc))
+    return selected
+
+
+def ignored_testcases(selected, excluded):
+    """Returns the names of the selected test cases that have any of the excluded dependencies
+
+    The dependencies of a testset count as dependencies of all of its test cases.
+    """
+    dependency_index = DependencyIndex()
+    for ts in OrderedDict((ts.name, ts) for ts, tc in selected).values():
+        dependency_index.update(ts.dependency_index)
+    return dependency_index.matching(excluded)
+
+
+def select_shard(selected, index, count, timings=None, ignored=()):
+    """Returns the index-th (1-based) of count parts of the selected (testset, testcase) tuples
+
+    The partition is deterministic. Test cases whose names are in ignored take no time,
+    so they are spread over the parts separately: every part gets (almost) the same
+    number of them. Without timings, the parts get consecutive runs of (almost) the
+    same number of the other test cases. With timings (as in a report), these are
+    assigned to parts so that the total time of the parts is about the same; test
+    cases without timings count as taking the median time.
+    The selected order is kept within each part.
+    """
+    assigned = [0] * len(selected)
+    ignored_positions = [p for p, (ts, tc) in enumerate(selected) if tc.name in ignored]
+    run_positions = [p for p, (ts, tc) in enumerate(selected) if tc.name not in ignored]
+    for number, position in enumerate(ignored_positions):
+        assigned[position] = number * count // len(ignored_positions)
+
+    if timings is None:
+        for number, position in enumerate(run_positions):
+            assigned[position] = number * count // len(run_positions)
+    else:
+        def total(timing):
+            return sum(timing.get(t, 0.0) for t in TIMINGS)
+
+        times = {}
+        for position in run_positions:
+            name = selected[position][1].name
+            times[position] = total(timings[name]) if name in timings else None
+        known = sorted(t for t in times.values() if t is not None)
+        median = known[len(known) // 2] if known else 1.0
+        times = {position: median if t is None else t for position, t in times.items()}
+
+        # longest processing time first, onto the part with the least total time
+        loads = [0.0] * count
+        for position in sorted(run_positions, key=lambda p: (-times[p], selected[p][1].name)):
+            part = min(range(count), key=lambda k: (loads[k], k))
+            loads[part] += times[position]
+            assigned[position] = part
+    return [item for item, part in zip(selected, assigned) if part == index - 1]
+
+
+class PreviousReport(object):
+    """A report of an earlier run, from which outcomes can be carried forward into a new report"""
+
+    def __init__(self, filename):
+        with open(filename, 'r') as infile:
+            report = json.load(infile)
+        self.statuses = {}
+        for status in REPORT_STATUSES:
+            for name in report.get(status, []):
+                self.statuses[name] = status
+        self.timings = report.get("timings", {})
+        self.testset_files = report.get("testset_files", {})
+
+    def testset_changed(self, testset, stamp):
+        return self.testset_files.get(testset) != stamp
+
+    def outcome(self, name, testset):
+        """Returns the Outcome of the test case in this report, or None if it is not listed"""
+        status = self.statuses.get(name)
+        if status is None:
+            return None
+        timings = self.timings.get(name)
+        return Outcome(name, status, ran=status in ("success", "failed"), testset=testset,
+                       timings=OrderedDict(timings) if timings else None)
+
+
+class ResourceGuard(object):
+    """Context manager that limits the wall-clock time and memory used by the code it wraps
+
+    timeout is in seconds, memory_limit is the memory (in megabytes) that may be allocated
+    on top of what the process uses when the guard is entered; 0 means no limit.
+    When a limit is exceeded, TestTimeout or ResourceExceeded is raised.
+    The timeout can only be enforced in the main thread, and the memory limit only
+    on platforms that have the resource module and /proc/self/statm.
+    """
+
+    def __init__(self, timeout=0, memory_limit=0):
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._previous_handler = None
+        self._previous_rlimit = None
+
+    @staticmethod
+    def _on_alarm(signum, frame):
+        raise TestTimeout("test case timed out")
+
+    @staticmethod
+    def _address_space_size():
+        try:
+            with open('/proc/self/statm') as infile:
+                return int(infile.read().split()[0]) * resource.getpagesize()
+        except (OSError, ValueError):
+            return None
+
+    def __enter__(self):
+        if self.timeout and hasattr(signal, 'setitimer') and \
+                threading.current_thread() is threading.main_thread():
+            self._previous_handler = signal.signal(signal.SIGALRM, self._on_alarm)
+            signal.setitimer(signal.ITIMER_REAL, self.timeout)
+        if self.memory_limit and resource is not None:
+            size = self._address_space_size()
+            if size is not None:
+                self._previous_rlimit = resource.getrlimit(resource.RLIMIT_AS)
+                soft_limit = size + self.memory_limit * 1024 * 1024
+                hard_limit = self._previous_rlimit[1]
+                if hard_limit != resource.RLIM_INFINITY:
+                    soft_limit = min(soft_limit, hard_limit)
+                resource.setrlimit(resource.RLIMIT_AS, (soft_limit, hard_limit))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._previous_handler is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self._previous_handler)
+            self._previous_handler = None
+        if self._previous_rlimit is not None:
+            resource.setrlimit(resource.RLIMIT_AS, self._previous_rlimit)
+            self._previous_rlimit = None
+        if exc_type is MemoryError:
+            raise ResourceExceeded(exc_val)
+
+
+class TestProfiler(object):
+    """Profiles test cases with cProfile, writing the profile of every test case to a .pstats file in directory
+
+    The files are named after the test cases; aggregate() combines them into one profile.
+    """
+
+    AGGREGATE_FILE = "aggregate.pstats"
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, name):
+        return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', name) + ".pstats")
+
+    def runcall(self, name, function, *args):
+        """Calls function with args, and writes its profile (also if it raises an exception)"""
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            profile.dump_stats(self.path(name))
+
+    def aggregate(self, names):
+        """Combines the profiles of the given test cases, writes them to AGGREGATE_FILE and returns them
+
+        Returns None if none of the test cases has a profile.
+        """
+        stats = None
+        for name in names:
+            path = self.path(name)
+            if not os.path.exists(path):
+                continue
+            if stats is None:
+                stats = pstats.Stats(path)
+            else:
+                stats.add(path)
+        if stats is None:
+            return None
+        path = os.path.join(self.directory, TestProfiler.AGGREGATE_FILE)
+        stats.dump_stats(path)
+        return pstats.Stats(path)
+
+
+def run_testcase(test_context, guard=None, profiler=None):
+    """Runs a single test case and returns its Outcome, printing failures according to the verbosity
+
+    If a ResourceGuard is given, the test case is run within its limits. If a TestProfiler
+    is given, the test case is profiled.
+    The time spent in parsing and evaluating the test expression is taken from the
+    test context; the rest of the time is attributed to checking the assertions.
+    """
+    start = time.perf_counter()
+    outcome = _run_testcase(test_context, guard, profiler)
+    elapsed = time.perf_counter() - start
+    parse_time = test_context.timings.get("parse", 0.0)
+    evaluate_time = test_context.timings.get("evaluate", 0.0)
+    outcome.testset = test_context.testset.name
+    outcome.timings = OrderedDict([
+        ("parse", parse_time),
+        ("evaluate", evaluate_time),
+        ("assert", max(elapsed - parse_time - evaluate_time, 0.0)),
+    ])
+    return outcome
+
+
+def error_name(exc):
+    """Returns the name of the class of an exception, or of the exception it wraps (through any ExecutionErrors)"""
+    while isinstance(exc, ExecutionError) and exc.args and isinstance(exc.args[0], BaseException):
+        exc = exc.args[0]
+    return type(exc).__name__
+
+
+def _run_testcase(test_context, guard, profiler):
+    tc = test_context.testcase
+    verbose = test_context.verbose
+    if guard is None:
+        guard = ResourceGuard()
+    try:
+        with guard:
+            if profiler is not None:
+                result = profiler.runcall(tc.name, tc.run, test_context)
+            else:
+                result = tc.run(test_context)
+        if result is None:
+            return Outcome(tc.name, "skipped", ran=True)
+        if result is False:
+            return Outcome(tc.name, "failed", ran=True)
+        return Outcome(tc.name, "success", ran=True)
+    except TestTimeout as timeoutError:
+        if verbose >= 2:
+            print("test %s timed out after %s seconds" % (tc.name, guard.timeout))
+        return Outcome(tc.name, "timeout", error=error_name(timeoutError))
+    except ResourceExceeded as resourceError:
+        if verbose >= 2:
+            print("test %s exceeded the memory limit of %d MB" % (tc.name, guard.memory_limit))
+        return Outcome(tc.name, "resource_exceeded", error=error_name(resourceError))
+    except ParseError as parseError:
+        if verbose >= 2:
+            print("failure in parsing test statement for test " + tc.name)
+            print("%s: %s" % (str(type(parseError)), str(parseError)))
+        if verbose >= 5:
+            traceback.print_exc()
+        return Outcome(tc.name, "parse_error", error=error_name(parseError))
+    except EvaluateError as evalError:
+        if verbose >= 2:
+            print("failure in evaluating test statement for test " + tc.name)
+            print("%s: %s" % (str(type(evalError)), str(evalError)))
+        if verbose >= 5:
+            traceback.print_exc()
+        return Outcome(tc.name, "evaluate_error", error=error_name(evalError))
+    except ExecutionError as execError:
+        if verbose >= 2:
+            print("failure in executing testcase for test " + tc.name)
+            print("%s: %s" % (str(type(execError)), str(execError)))
+        if verbose >= 5:
+            traceback.print_exc()
+        return Outcome(tc.name, "execute_error", error=error_name(execError))
+    except Exception as exc2:
+        if verbose >= 0:
+            print("failure in test code for test " + tc.name)
+            print("%s: %s" % (str(type(exc2)), str(exc2)))
+        if verbose >= 5:
+            traceback.print_exc()
+        return Outcome(tc.name, "testcode_error", error=error_name(exc2))
+
+
+# State of a worker process, set up once by init_worker
+_worker_catalog = None
+_worker_verbose = 1
+_worker_guard = None
+_worker_profiler = None
+
+
+def init_worker(catalog_file, verbose, guard, source_cache_size, index_path, profiler=None):
+    global _worker_catalog, _worker_verbose, _worker_guard, _worker_profiler
+    # Every worker reads the catalog itself, so it has its own
+    # environments and parsed source documents
+    source_cache.maxsize = source_cache_size
+    context_factory.maxsize = source_cache_size
+    index = CatalogIndex(index_path) if index_path else None
+    _worker_catalog = Catalog(catalog_file, index)
+    _worker_verbose = verbose
+    _worker_guard = guard
+    _worker_profiler = profiler
+    os.chdir(os.path.dirname(_worker_catalog.file))
+
+
+def run_batch(batch):
+    testset_name, testcase_names = batch
+    testset = _worker_catalog.testsets[testset_name]
+    testcases = {tc.name: tc for tc in testset.testcases}
+    outcomes = []
+    for name in testcase_names:
+        test_context = TestContext(_worker_catalog.environments, testset, testcases[name], _worker_verbose)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            outcome = run_testcase(test_context, _worker_guard, _worker_profiler)
+        outcome.output = output.getvalue()
+        outcomes.append(outcome)
+    return outcomes
+
+
+def _make_batches(plan):
+    batches = []
+    for testset, item in plan:
+        if isinstance(item, Outcome):
+            continue
+        if batches and batches[-1][0] == testset.name and len(batches[-1][1]) < BATCH_SIZE:
+            batches[-1][1].append(item.name)
+        else:
+            batches.append((testset.name, [item.name]))
+    return batches
+
+
+class _IsolatedWorker(object):
+    """A worker process of run_plan with isolate=True, and the test case it is running"""
+
+    def __init__(self, initargs):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_isolated_worker_main, args=(child_connection,) + initargs)
+        self.process.daemon = True
+        self.process.start()
+        child_connection.close()
+        self.position = None
+        self.started = None
+
+    def start(self, position, testset, testcase):
+        self.position = position
+        self.started = time.monotonic()
+        try:
+            self.connection.send((testset.name, testcase.name))
+        except OSError:
+            # the process died, which is noticed when its answer is waited for
+            pass
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+def _isolated_worker_main(connection, *initargs):
+    init_worker(*initargs)
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        testset_name, testcase_name = request
+        connection.send(run_batch((testset_name, [testcase_name]))[0])
+
+
+def _run_isolated(catalog, plan, verbose, jobs, guard, stream, profiler, hang_timeout):
+    """Runs the test cases of the plan in supervised worker processes (see run_plan)"""
+    index_path = catalog.index.path if catalog.index is not None else None
+    initargs = (catalog.file, verbose, guard, source_cache.maxsize, index_path, profiler)
+    # a worker that takes this much longer than the timeout is considered to hang
+    hang_limit = hang_timeout
+    if hang_limit is None:
+        hang_limit = guard.timeout + HANG_GRACE if guard.timeout else DEFAULT_HANG_TIMEOUT
+
+    todo = [position for position, (testset, item) in enumerate(plan) if not isinstance(item, Outcome)]
+    todo.reverse()
+    # the positions of the test cases that were given to a worker that died
+    retried = set()
+    landed = {}
+    workers = []
+    next_position = 0
+    try:
+        while next_position < len(plan):
+            # yield everything that is known, in the order of the plan
+            while next_position < len(plan):
+                testset, item = plan[next_position]
+                if isinstance(item, Outcome):
+                    yield item
+                elif next_position in landed:
+                    outcome = landed.pop(next_position)
+                    if outcome.output:
+                        sys.stdout.write(outcome.output)
+                    yield outcome
+                else:
+                    break
+                next_position += 1
+            if next_position >= len(plan):
+                break
+
+            for worker in [worker for worker in workers if worker.position is None and not worker.process.is_alive()]:
+                # the worker exited after its last test case
+                worker.kill()
+                workers.remove(worker)
+            while todo and len(workers) < jobs:
+                workers.append(_IsolatedWorker(initargs))
+            for worker in workers:
+                if worker.position is None and todo:
+                    position = todo.pop()
+                    worker.start(position, *plan[position])
+
+            busy = [worker for worker in workers if worker.position is not None]
+            multiprocessing.connection.wait([worker.connection for worker in busy] +
+                                            [worker.process.sentinel for worker in busy], timeout=1)
+            for worker in busy:
+                testset, testcase = plan[worker.position]
+                reason = None
+                died = True
+                # a worker can answer and exit between the two checks, so it is checked first
+                alive = worker.process.is_alive()
+                try:
+                    if worker.connection.poll():
+                        outcome = worker.connection.recv()
+                    elif not alive:
+                        reason = "the worker process exited with code %s" % worker.process.exitcode
+                    elif hang_limit and time.monotonic() - worker.started > hang_limit:
+                        reason = "the worker process did not respond for %d seconds" % hang_limit
+                        died = False
+                    else:
+                        continue
+                except (EOFError, OSError):
+                    worker.process.join(1)
+                    reason = "the worker process exited with code %s" % worker.process.exitcode
+                if reason is not None:
+                    worker.kill()
+                    workers.remove(worker)
+                    if died and worker.position not in retried:
+                        # the worker may have died before it ran the test case, so it
+                        # is run once more in a new worker; it crashed if it kills that one too
+                        retried.add(worker.position)
+                        new_worker = _IsolatedWorker(initargs)
+                        new_worker.start(worker.position, testset, testcase)
+                        workers.append(new_worker)
+                        continue
+                    output = ""
+                    if verbose >= 2:
+                        output = "test %s crashed: %s\n" % (testcase.name, reason)
+                    outcome = Outcome(testcase.name, "crashed", testset=testset.name, error=reason, output=output)
+                if stream is not None:
+                    stream.write(outcome)
+                landed[worker.position] = outcome
+                worker.position = None
+    finally:
+        for worker in workers:
+            worker.stop()
+
+
+def run_plan(catalog, plan, verbose, jobs=1, guard=None, isolate=False, stream=None, profiler=None,
+             hang_timeout=None):
+    """Yields an Outcome for every entry of plan, in the order of the plan
+
+    plan is a list of (testset, item) tuples, where item is either a TestCase to run or a
+    precomputed Outcome (for test cases that are ignored or skipped).
+    With jobs > 1 the test cases are run in a pool of worker processes, and the
+    output they print is collected and returned with the outcome; the outcomes
+    are the same as those of a serial run.
+    Test cases are run within the limits of the given ResourceGuard.
+
+    With isolate, every test case is run in one of jobs supervised worker processes; when
+    a worker dies (for instance on a crash in native code) or hangs, the test case it was
+    running gets the status 'crashed' and a new worker takes over. A worker hangs when it
+    doesn't respond for hang_timeout seconds; by default, HANG_GRACE seconds longer than
+    the timeout of the guard, or DEFAULT_HANG_TIMEOUT if the guard has no timeout.
+    The outcomes of the test cases that are run are written to the given OutcomeStream
+    as soon as they are known.
+    If a TestProfiler is given, every test case that is run is profiled.
+    """
+    if guard is None:
+        guard = ResourceGuard()
+    if isolate:
+        yield from _run_isolated(catalog, plan, verbose, max(jobs, 1), guard, stream, profiler, hang_timeout)
+        return
+
+    if jobs <= 1:
+        for testset, item in plan:
+            if isinstance(item, Outcome):
+                yield item
+            else:
+                outcome = run_testcase(TestContext(catalog.environments, testset, item, verbose), guard, profiler)
+                if stream is not None:
+                    stream.write(outcome)
+                yield outcome
+        return
+
+    index_path = catalog.index.path if catalog.index is not None else None
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(catalog.file, verbose, guard, source_cache.maxsize, index_path,
+                                       profiler)) as executor:
+        batch_results = executor.map(run_batch, _make_batches(plan))
+        pending = []
+        for testset, item in plan:
+            if isinstance(item, Outcome):
+                yield item
+                continue
+            if not pending:
+                pending = list(next(batch_results))
+            outcome = pending.pop(0)
+            if stream is not None:
+                stream.write(outcome)
+            if outcome.output:
+                sys.stdout.write(outcome.output)
+            yield outcome
@@ -1,63 +1,172 @@
 import os
+import re
+import datetime
 import decimal
-
+import hashlib
+import importlib
+import math
+import pickle
+import sqlite3
+import sys
+import time
+
+from collections import Counter, OrderedDict
+from itertools import zip_longest
 from lxml import etree
-from util import WorkingDirectory
 
 from elementpath import XPath2Parser, XPathContext, select
+from elementpath.datatypes import UntypedAtomic
+from elementpath.xpath_nodes import AttributeNode, NamespaceNode, TextNode
 import elementpath
 
 
 nsmap = {None: "http://www.w3.org/2010/09/qt-fots-catalog"}
 
+# Used to find the test case names in a testset file without parsing it
+TESTCASE_NAME_RE = re.compile(rb'<test-case\s[^>]*?\bname\s*=\s*["\']([^"\']*)["\']')
+
+
+def intern(value):
+    """Interns a string read from the test suite (that may be None)
+
+    Names, dependencies and the like occur many times over in the test suite;
+    interning them keeps a single copy of every distinct value in memory.
+    """
+    return sys.intern(value) if value is not None else None
+
 
 class Schema(object):
     """Represents an XML schema as pointed to in test xml files (currently not used)"""
 
+    __slots__ = ('uri', 'file')
+
     def __init__(self, element):
-        self.uri = element.attrib.get('uri')
-        self.file = element.attrib.get('file')
-        description_xml = element.find('description', namespaces=nsmap)
-        if description_xml is not None:
-            self.description = description_xml.text
-        else:
-            self.description = ""
+        self.uri = intern(element.attrib.get('uri'))
+        self.file = intern(element.attrib.get('file'))
 
         # TODO: add schema tools?
 
 
-class Source(object):
-    """Represents a source file as used in environment xml settings"""
+class SourceCache(object):
+    """A bounded cache of parsed source documents, shared by all environments
 
-    def __init__(self, element):
-        self.role = element.attrib.get('role')
-        self.uri = element.attrib.get('uri')
-        self.file = element.attrib['file']
-        description_xml = element.find('description', namespaces=nsmap)
-        if description_xml is not None:
-            self.description = description_xml.text
-        else:
-            self.description = ""
+    Documents are keyed on their absolute path and modification time; when the cache
+    is full, the least recently used document is dropped.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.documents = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        key = (path, os.path.getmtime(path))
+        if key in self.documents:
+            self.hits += 1
+            self.documents.move_to_end(key)
+            return self.documents[key]
 
+        self.misses += 1
         try:
-            self.xml = etree.parse(self.file)
+            document = etree.parse(path)
         except etree.XMLSyntaxError:
-            self.xml = None
+            document = None
+        self.documents[key] = document
+        while len(self.documents) > self.maxsize:
+            self.documents.popitem(last=False)
+        return document
+
+    def clear(self):
+        self.documents.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+source_cache = SourceCache()
+
+
+# The context document of expressions that have no environment with a context document
+# of their own; it is never modified, so it can be shared by all evaluations
+EMPTY_DOCUMENT = etree.XML("<empty/>")
+
+
+class ContextFactory(object):
+    """Creates the XPathContexts that expressions are evaluated in, from a template context per document
+
+    Every context is a copy of the template with its own variables, focus and current
+    dateTime, so that evaluations don't see each other's state; what copies do share
+    is the parent map of the document, which is built with the template (the contexts
+    themselves, with the variables of their tests, are not kept). The templates of at
+    most maxsize documents are kept (the least recently used are dropped); a template
+    holds a reference to its document, so the document can't be replaced by another
+    one with the same id.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.templates = OrderedDict()
+
+    def create(self, document, variables=None):
+        """Returns a new context for the document (XPathContext raises an error if it is None)"""
+        key = id(document)
+        if key in self.templates:
+            self.templates.move_to_end(key)
+            template = self.templates[key]
+        else:
+            template = XPathContext(root=document)
+            # copies take the parent map over from the template
+            template.parent_map
+            self.templates[key] = template
+
+        context = template.copy()
+        context.variables = dict(variables) if variables else {}
+        context.current_dt = datetime.datetime.now()
+        while len(self.templates) > self.maxsize:
+            self.templates.popitem(last=False)
+        return context
+
+    def clear(self):
+        self.templates.clear()
+
+
+context_factory = ContextFactory()
+
+
+class Source(object):
+    """Represents a source file as used in environment xml settings"""
+
+    __slots__ = ('role', 'uri', 'file', 'path')
+
+    def __init__(self, element, directory):
+        self.role = intern(element.attrib.get('role'))
+        self.uri = intern(element.attrib.get('uri'))
+        self.file = intern(element.attrib['file'])
+        # The document is parsed when it is first used, and shared through the source cache
+        self.path = intern(os.path.abspath(os.path.join(directory, self.file)))
+
+    @property
+    def xml(self):
+        return source_cache.get(self.path)
 
 
 class Environment(object):
-    def __init__(self, element):
+    """Represents an environment of the catalog or a testset file, whose source files are relative to directory"""
+
+    __slots__ = ('name', 'namespaces', 'schema', 'context_xml', 'variables_sources')
+
+    def __init__(self, element, directory):
         self.namespaces = {}
         self.schema = None
         self.context_xml = None
         self.variables_sources = {}
         if 'name' in element.attrib:
-            self.name = element.attrib['name']
+            self.name = intern(element.attrib['name'])
         else:
             self.name = 'anonymous'
 
         for namespace_xml in element.findall('namespace', namespaces=nsmap):
-            self.namespaces[namespace_xml.attrib['prefix']] = namespace_xml.attrib['uri']
+            self.namespaces[intern(namespace_xml.attrib['prefix'])] = intern(namespace_xml.attrib['uri'])
 
         for schema_xml in element.findall('schema', namespaces=nsmap):
             if self.schema is not None:
@@ -66,13 +175,261 @@ class Environment(object):
 
         for source_xml in element.findall('source', namespaces=nsmap):
             # self.sources.append = Source(source_xml)
-            source = Source(source_xml)
+            source = Source(source_xml, directory)
             if source.role == ".":
                 self.context_xml = source
             else:
                 self.variables_sources[source.role] = source
 
 
+# Parsers are shared by all expressions that use the same namespaces
+_parsers = {}
+
+# Token trees of (static) assertion expressions, by expression and namespaces
+# (at most COMPILED_EXPRESSIONS_MAXSIZE, the least recently used are dropped first),
+# or _NEEDS_VARIABLES for expressions that can only be parsed with their variables
+_compiled_expressions = OrderedDict()
+
+_NEEDS_VARIABLES = object()
+
+COMPILED_EXPRESSIONS_MAXSIZE = 1024
+
+# Matches references to the $result variable of assertions
+RESULT_VARIABLE_RE = re.compile(r'\$\s*result\b')
+
+
+def _namespaces_key(namespaces):
+    return tuple(sorted(namespaces.items())) if namespaces else ()
+
+
+def get_parser(namespaces=None):
+    """Returns a shared XPath2Parser for the given namespaces
+
+    Variables are not part of the parser configuration; they are bound at evaluation
+    time through the variables of the XPathContext.
+    """
+    key = _namespaces_key(namespaces)
+    if key not in _parsers:
+        _parsers[key] = XPath2Parser(namespaces=namespaces)
+    return _parsers[key]
+
+
+def compile_expression(expression, namespaces=None, variables=None):
+    """Returns the parsed token tree of an expression, parsing it only once while it is used
+
+    elementpath evaluates parts of an expression (like casts) while parsing it, which fails
+    when the values of its variables are not known. If the shared parser fails and variables
+    are given, the expression is parsed with them, and it is remembered that it has to be
+    parsed like that every time.
+    """
+    key = (expression, _namespaces_key(namespaces))
+    if key in _compiled_expressions:
+        _compiled_expressions.move_to_end(key)
+        root_node = _compiled_expressions[key]
+        if root_node is not _NEEDS_VARIABLES:
+            return root_node
+        return XPath2Parser(namespaces=namespaces, variables=variables).parse(expression)
+
+    try:
+        root_node = get_parser(namespaces).parse(expression)
+        _compiled_expressions[key] = root_node
+    except Exception:
+        if not variables:
+            raise
+        root_node = XPath2Parser(namespaces=namespaces, variables=variables).parse(expression)
+        _compiled_expressions[key] = _NEEDS_VARIABLES
+    while len(_compiled_expressions) > COMPILED_EXPRESSIONS_MAXSIZE:
+        _compiled_expressions.popitem(last=False)
+    return root_node
+
+
+def clear_parser_caches():
+    _parsers.clear()
+    _compiled_expressions.clear()
+
+
+def reload_elementpath():
+    """Imports elementpath again, so that changes to it are used, and clears the caches that depend on it
+
+    The catalog doesn't refer to elementpath objects, so it can be kept.
+    """
+    global elementpath, XPath2Parser, XPathContext, select, UntypedAtomic, AttributeNode, NamespaceNode, TextNode
+    for name in list(sys.modules):
+        if name == 'elementpath' or name.startswith('elementpath.'):
+            del sys.modules[name]
+    importlib.invalidate_caches()
+    import elementpath
+    from elementpath import XPath2Parser, XPathContext, select
+    from elementpath.datatypes import UntypedAtomic
+    from elementpath.xpath_nodes import AttributeNode, NamespaceNode, TextNode
+    clear_parser_caches()
+    context_factory.clear()
+    return elementpath
+
+
+def as_sequence(value):
+    """Returns the result of an XPath evaluation as a list of items"""
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def node_key(element):
+    """Returns the name, attributes and content of an element as a hashable value
+
+    Comments and processing instructions are left out, as fn:deep-equal does.
+    """
+    content = []
+    if element.text:
+        content.append(element.text)
+    for child in element:
+        if isinstance(child.tag, str):
+            content.append(node_key(child))
+        if child.tail:
+            content.append(child.tail)
+    return element.tag, frozenset(element.attrib.items()), tuple(content)
+
+
+def item_key(item):
+    """Returns a hashable key for an item of a sequence, such that items are deep-equal if their keys are equal
+
+    Returns None for items that have no such key (like dates and durations, where
+    equal values of different types may hash differently). Integers and decimals are
+    keyed on their exact value, doubles on their double value; these keys can't be
+    compared to each other (see comparison_keys).
+    """
+    if isinstance(item, bool):
+        return 'boolean', item
+    if isinstance(item, (int, decimal.Decimal)):
+        return 'decimal', item
+    if isinstance(item, float):
+        if math.isnan(item):
+            # NaN is deep-equal to NaN
+            return 'double', 'NaN'
+        return 'double', item
+    if isinstance(item, (str, UntypedAtomic)):
+        return 'string', str(item)
+    if isinstance(item, (AttributeNode, TextNode, NamespaceNode)):
+        return (type(item).__name__,) + tuple(item)
+    if isinstance(item, etree._ElementTree):
+        return 'document', node_key(item.getroot())
+    if etree.iselement(item) and isinstance(item.tag, str):
+        return 'element', node_key(item)
+    return None
+
+
+def sequence_keys(value):
+    """Returns the item keys of a sequence, or None if not all items have one"""
+    keys = []
+    for item in as_sequence(value):
+        key = item_key(item)
+        if key is None:
+            return None
+        keys.append(key)
+    return keys
+
+
+def comparison_keys(first, second):
+    """Returns the item keys of two sequences that are to be compared, or None if they can't be compared by key
+
+    Besides sequences with items that have no key, this is the case when the sequences
+    contain both doubles and integers or decimals: comparing these promotes the
+    decimal to a double, which can't be done for the keys without losing precision.
+    """
+    first_keys = sequence_keys(first)
+    second_keys = sequence_keys(second)
+    if first_keys is None or second_keys is None:
+        return None
+    kinds = set(key[0] for key in first_keys + second_keys)
+    if 'decimal' in kinds and 'double' in kinds:
+        return None
+    return first_keys, second_keys
+
+
+def _node_events(items, path, tails=False):
+    counts = Counter()
+    for item in items:
+        if isinstance(item, etree._ElementTree):
+            item = item.getroot()
+        if isinstance(item, TextNode):
+            yield path, ('text', item.value)
+        elif isinstance(item, AttributeNode):
+            yield path, ('attribute', item.name, item.value)
+        elif not etree.iselement(item):
+            yield path, ('text', str(item))
+        elif item.tag is etree.Comment:
+            yield path, ('comment', item.text)
+        elif item.tag is etree.ProcessingInstruction:
+            yield path, ('pi', item.target, item.text)
+        else:
+            name = etree.QName(item).localname
+            counts[name] += 1
+            item_path = "%s/%s[%d]" % (path, name, counts[name])
+            yield item_path, ('start', item.tag, tuple(sorted(item.attrib.items())))
+            yield from _content_events(item, item_path)
+            yield item_path, ('end', item.tag)
+        if tails and item.tail:
+            yield path, ('text', item.tail)
+
+
+def _content_events(element, path):
+    if element.text:
+        yield path, ('text', element.text)
+    yield from _node_events(element, path, tails=True)
+
+
+def _canonical_events(events):
+    texts = []
+    text_path = None
+    for path, event in events:
+        if event[0] == 'text':
+            if not texts:
+                text_path = path
+            texts.append(event[1])
+            continue
+        if texts:
+            text = "".join(texts)
+            if text.strip():
+                yield text_path, ('text', text)
+            texts = []
+        yield path, event
+    if texts:
+        text = "".join(texts)
+        if text.strip():
+            yield text_path, ('text', text)
+
+
+def xml_events(items):
+    """Yields the events of a walk over a sequence of nodes, in canonical form, as (path, event) tuples
+
+    Attributes are sorted, adjacent texts are merged, and texts that only contain
+    whitespace are left out; path is the XPath of the element the event is in.
+    """
+    return _canonical_events(_node_events(items, ""))
+
+
+def fragment_events(element):
+    """Yields the canonical events of the content of an element, as xml_events does"""
+    return _canonical_events(_content_events(element, ""))
+
+
+def first_xml_difference(output_events, expected_events):
+    """Returns the (path, output event, expected event) of the first difference of two event streams, or None"""
+    for output_event, expected_event in zip_longest(output_events, expected_events, fillvalue=(None, None)):
+        if output_event[1] != expected_event[1]:
+            return expected_event[0] or output_event[0] or "/", output_event[1], expected_event[1]
+    return None
+
+
+def deep_equal(first, second):
+    """Returns the result of fn:deep-equal for two values"""
+    root_node = compile_expression("fn:deep-equal($first, $second)")
+    context = context_factory.create(EMPTY_DOCUMENT, {'first': first, 'second': second})
+    return root_node.evaluate(context) == True
+
+
 class ExecutionError(Exception):
     pass
 
@@ -85,9 +442,43 @@ class EvaluateError(ExecutionError):
     pass
 
 
+class TestInterrupted(BaseException):
+    """Raised when a test case exceeds its time or memory limit
+
+    This is not an Exception, so that it is not caught as a test failure (or success)
+    by the assertions that handle errors of the test expression.
+    """
+    pass
+
+
+class TestTimeout(TestInterrupted):
+    pass
+
+
+class ResourceExceeded(TestInterrupted):
+    pass
+
+
 def create_and_run_test(test_context, may_fail=False):
-    """Helper function to parse and evaluate tests with elementpath"""
+    """Helper function to parse and evaluate tests with elementpath
+
+    The test is evaluated only once per test context; the result, or the exception
+    raised, is stored in the context and shared by all assertions of the test case.
+    """
     # if may_fail is true, raise the exception instead of printing and aborting
+    if not test_context.evaluated:
+        try:
+            test_context.output = _evaluate_test(test_context)
+        except Exception as exc:
+            test_context.error = exc
+        test_context.evaluated = True
+    if test_context.error is not None:
+        raise test_context.error
+    return test_context.output
+
+
+def context_document(test_context):
+    """Returns the document that is the context of the test case, as given by its environment"""
     env_ref = test_context.testcase.environment_ref
     if env_ref:
         if env_ref in test_context.testset.environments:
@@ -102,20 +493,36 @@ def create_and_run_test(test_context, may_fail=False):
         environment = None
 
     if environment is not None and environment.context_xml:
-        xml_doc = environment.context_xml.xml
+        return environment.context_xml.xml
     else:
-        xml_doc = etree.XML("<empty/>")
+        return EMPTY_DOCUMENT
 
+
+def _evaluate_test(test_context):
+    xml_doc = context_document(test_context)
+
+    timings = test_context.timings
     try:
-        parser = XPath2Parser()
-        root_node = parser.parse(test_context.testcase.test)
-        context = XPathContext(root=xml_doc)
+        parser = get_parser()
+        start = time.perf_counter()
+        try:
+            root_node = parser.parse(test_context.testcase.test)
+        finally:
+            timings['parse'] = time.perf_counter() - start
+        start = time.perf_counter()
         try:
+            context = context_factory.create(xml_doc)
             result = root_node.evaluate(context)
+        except MemoryError as memError:
+            raise ResourceExceeded(memError)
         except Exception as evalError:
             if test_context.verbose >= 2:
                 print("Error evaluating %s: %s" % (test_context.testcase.test, str(evalError)))
             raise EvaluateError(evalError)
+        finally:
+            timings['evaluate'] = time.perf_counter() - start
+    except MemoryError as memError:
+        raise ResourceExceeded(memError)
     except Exception as exc:
         if test_context.verbose >= 2:
             print("Error parsing %s: %s" % (test_context.testcase.test, str(exc)))
@@ -126,55 +533,227 @@ def create_and_run_test(test_context, may_fail=False):
 
 
 class TestSet(object):
-    """Represents a testset as read from the catalog file and the setset xml file itself"""
+    """Represents a testset as read from the catalog file and the setset xml file itself
+
+    The testset file is only read when one of its environments, testcases or dependencies
+    is first used.
+    """
+
+    lazy_attributes = ('environments', 'testcases', 'dependencies', 'dependency_index',
+                       'spec_dependencies', 'feature_dependencies', 'xml_version_dependency',
+                       'xsd_version_dependency')
+
+    __slots__ = ('name', 'file', 'path', 'index', 'loaded') + lazy_attributes
+
+    def __init__(self, element, directory, index=None):
+        self.name = intern(element.attrib['name'])
+        self.file = intern(element.attrib['file'])
+        self.path = os.path.abspath(os.path.join(directory, self.file))
+        self.index = index
+        self.loaded = False
+
+    def __getattr__(self, name):
+        if name in TestSet.lazy_attributes and not self.loaded:
+            self.load()
+            return getattr(self, name)
+        raise AttributeError("%r object has no attribute %r" % (type(self).__name__, name))
+
+    def testcase_names(self):
+        """Returns the (short) names of the test cases in the testset file, without parsing it"""
+        if self.index is not None:
+            names = self.index.lookup_names(self.path)
+            if names is not None:
+                return names
+        with open(self.path, 'rb') as infile:
+            names = [name.decode('utf-8') for name in TESTCASE_NAME_RE.findall(infile.read())]
+        if self.index is not None:
+            self.index.store_names(self.path, names)
+        return names
+
+    def matches(self, test_name):
+        """Returns True if any test case of this testset matches the given name filter"""
+        if test_name is None or test_name in self.name:
+            return True
+        prefix = self.name + "."
+        return any(test_name in prefix + name for name in self.testcase_names())
+
+    def load(self):
+        if self.index is not None:
+            state = self.index.lookup(self.path)
+            if state is not None:
+                for name, value in state.items():
+                    setattr(self, name, value)
+                self.loaded = True
+                return
 
-    def __init__(self, element):
-        self.name = element.attrib['name']
-        self.file = element.attrib['file']
         self.environments = {}
         self.testcases = []
 
+        self.dependencies = []
         self.spec_dependencies = []
         self.feature_dependencies = []
         self.xml_version_dependency = None
         self.xsd_version_dependency = None
 
-        full_path = os.path.abspath(self.file)
-        directory = os.path.dirname(full_path)
-        filename = os.path.basename(full_path)
-        with WorkingDirectory(directory):
-            xml_root = etree.parse(filename).getroot()
-
-            self.description = xml_root.find('description', namespaces=nsmap).text
-
-            for dependency_xml in xml_root.findall('dependency', namespaces=nsmap):
-                dep_type = dependency_xml.attrib['type']
-                value = dependency_xml.attrib['value']
-                if dep_type == 'spec':
-                    self.spec_dependencies.extend(value.split(' '))
-                elif dep_type == 'feature':
-                    self.feature_dependencies.append(value)
-                elif dep_type == 'xml-version':
-                    self.xml_version_dependency = value
-                elif dep_type == 'xsd-version':
-                    self.xsd_version_dependency = value
-                elif dep_type == 'default-language' or dep_type == 'language':
-                    pass
-                elif dep_type == 'limits' or dep_type == 'calendar':
-                    # TODO What do we need to do here?
-                    pass
-                else:
-                    # print("unknown dependency type: %s = %s" % (dep_type, value))
-                    # sys.exit(4)
-                    # ignore other deps for now
-                    pass
+        directory = os.path.dirname(self.path)
+        xml_root = etree.parse(self.path).getroot()
+
+        for dependency_xml in xml_root.findall('dependency', namespaces=nsmap):
+            dep_type = intern(dependency_xml.attrib['type'])
+            value = intern(dependency_xml.attrib['value'])
+            self.dependencies.append((dep_type, value))
+            if dep_type == 'spec':
+                self.spec_dependencies.extend(value.split(' '))
+            elif dep_type == 'feature':
+                self.feature_dependencies.append(value)
+            elif dep_type == 'xml-version':
+                self.xml_version_dependency = value
+            elif dep_type == 'xsd-version':
+                self.xsd_version_dependency = value
+            elif dep_type == 'default-language' or dep_type == 'language':
+                pass
+            elif dep_type == 'limits' or dep_type == 'calendar':
+                # TODO What do we need to do here?
+                pass
+            else:
+                # print("unknown dependency type: %s = %s" % (dep_type, value))
+                # sys.exit(4)
+                # ignore other deps for now
+                pass
+
+        for environment_xml in xml_root.findall('environment', namespaces=nsmap):
+            environment = Environment(environment_xml, directory)
+            self.environments[environment.name] = environment
+
+        for testcase_xml in xml_root.findall('test-case', namespaces=nsmap):
+            self.testcases.append(TestCase(testcase_xml, self))
+
+        # the dependencies of the testset apply to all of its test cases
+        self.dependency_index = DependencyIndex()
+        for tc in self.testcases:
+            for dep_type, value in self.dependencies + list(tc.dependencies):
+                self.dependency_index.add(dep_type, value, tc.name)
+        self.loaded = True
+
+        if self.index is not None:
+            self.index.store(self.path, {name: getattr(self, name) for name in TestSet.lazy_attributes})
+
+
+class DependencyIndex(object):
+    """Maps dependencies, as (type, value) tuples, to the names of the test cases that have them
+
+    Dependency values that list several values (like spec="XP20+ XQ10+") are split,
+    so every value gets its own entry.
+    """
 
-            for environment_xml in xml_root.findall('environment', namespaces=nsmap):
-                environment = Environment(environment_xml)
-                self.environments[environment.name] = environment
+    def __init__(self):
+        self.testcases = {}
 
-            for testcase_xml in xml_root.findall('test-case', namespaces=nsmap):
-                self.testcases.append(TestCase(testcase_xml, self))
+    def add(self, dep_type, value, name):
+        for single_value in value.split():
+            self.testcases.setdefault((dep_type, single_value), set()).add(name)
+
+    def update(self, other):
+        for dependency, names in other.testcases.items():
+            self.testcases.setdefault(dependency, set()).update(names)
+
+    def matching(self, dependencies):
+        """Returns the names of the test cases that have any of the given dependencies"""
+        names = set()
+        for dependency in dependencies:
+            names.update(self.testcases.get(dependency, ()))
+        return names
+
+
+class CatalogIndex(object):
+    """An on-disk index of loaded testsets, so that later runs don't have to parse the testset files again
+
+    The index is an SQLite database with a pickled row per testset file, keyed on the
+    modification time and size of the file; rows of changed files are ignored (and
+    replaced when the file is parsed again). The whole index is dropped when this
+    module changes, since the pickled objects depend on it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # the index may be used from another thread than the one that opened it
+        # (see async_harness.py), but never from two threads at the same time
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS testsets "
+                                "(path TEXT PRIMARY KEY, stamp TEXT, names BLOB, state BLOB)")
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'harness'").fetchone()
+        if row is None or row[0] != harness_stamp():
+            self.connection.execute("DELETE FROM testsets")
+            self.connection.execute("REPLACE INTO meta VALUES ('harness', ?)", (harness_stamp(),))
+            self.connection.commit()
+
+    def _lookup(self, path, column):
+        row = self.connection.execute("SELECT stamp, %s FROM testsets WHERE path = ?" % column,
+                                      (path,)).fetchone()
+        if row is None or row[0] != file_stamp(path) or row[1] is None:
+            return None
+        return pickle.loads(row[1])
+
+    def _store(self, path, column, value):
+        stamp = file_stamp(path)
+        row = self.connection.execute("SELECT stamp FROM testsets WHERE path = ?", (path,)).fetchone()
+        if row is None or row[0] != stamp:
+            self.connection.execute("REPLACE INTO testsets (path, stamp) VALUES (?, ?)", (path, stamp))
+        self.connection.execute("UPDATE testsets SET %s = ? WHERE path = ?" % column,
+                                (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), path))
+
+    def lookup(self, path):
+        return self._lookup(path, 'state')
+
+    def store(self, path, state):
+        self._store(path, 'state', state)
+
+    def lookup_names(self, path):
+        return self._lookup(path, 'names')
+
+    def store_names(self, path, names):
+        self._store(path, 'names', names)
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def file_stamp(path):
+    """Returns a string that changes when the file at path is modified"""
+    stat = os.stat(path)
+    return "%d:%d" % (stat.st_mtime_ns, stat.st_size)
+
+
+def harness_stamp():
+    """Returns a hash of the source of this module"""
+    with open(os.path.abspath(__file__), 'rb') as infile:
+        return hashlib.sha1(infile.read()).hexdigest()
+
+
+class Catalog(object):
+    """Represents the catalog file, with the global environments and the testsets it refers to"""
+
+    def __init__(self, filename, index=None):
+        self.file = os.path.abspath(filename)
+        self.index = index
+        self.environments = {}
+        self.testsets = {}
+
+        directory = os.path.dirname(self.file)
+        catalog_xml = etree.parse(self.file)
+
+        for environment_xml in catalog_xml.getroot().findall("environment", namespaces=nsmap):
+            environment = Environment(environment_xml, directory)
+            self.environments[environment.name] = environment
+
+        for testset_xml in catalog_xml.getroot().findall("test-set", namespaces=nsmap):
+            testset = TestSet(testset_xml, directory, index)
+            self.testsets[testset.name] = testset
 
 
 class TestContext(object):
@@ -191,51 +770,48 @@ class TestContext(object):
         # other data
         self.verbose = verbose
 
+        # The evaluation of the test, filled in by create_and_run_test
+        self.evaluated = False
+        self.output = None
+        self.error = None
+        self.timings = {}
+
 
 class TestCase(object):
-    """Represents a test case as read from a testset file"""
+    """Represents a test case as read from a testset file
+
+    The description of the test case is not kept in memory; it is read from the
+    testset file again when the test case is printed.
+    """
+
+    __slots__ = ('testset_file', 'name', 'test', 'result', 'environment_ref', 'environment', 'dependencies')
 
     def __init__(self, element, testset):
-        self.testset_file = testset.file
+        self.testset_file = testset.path
         self.name = testset.name + "." + element.attrib['name']
-        self.description = element.find('description', namespaces=nsmap).text
         self.test = element.find('test', namespaces=nsmap).text
         self.result = Result(element.find('result', namespaces=nsmap).find("*"))
         self.environment_ref = None
         self.environment = None
-        self.spec_dependencies = []
-        self.feature_dependencies = []
-        self.xml_version_dependency = None
-        self.xsd_version_dependency = None
-
-        for dependency_xml in element.findall('dependency', namespaces=nsmap):
-            dep_type = dependency_xml.attrib['type']
-            value = dependency_xml.attrib['value']
-            if dep_type == 'spec':
-                self.spec_dependencies.extend(value.split(' '))
-            elif dep_type == 'feature':
-                self.feature_dependencies.append(value)
-            elif dep_type == 'xml-version':
-                self.xml_version_dependency = value
-            elif dep_type == 'xsd-version':
-                self.xsd_version_dependency = value
-            elif dep_type == 'default-language' or dep_type == 'language':
-                pass
-            elif dep_type == 'limits' or dep_type == 'calendar':
-                # TODO What do we need to do here?
-                pass
-            else:
-                # print("unknown dependency type: %s = %s" % (dep_type, value))
-                # sys.exit(4)
-                # ignore other deps for now
-                pass
+        # the test case dependencies are used through the dependency index of the testset
+        self.dependencies = tuple((intern(dependency_xml.attrib['type']), intern(dependency_xml.attrib['value']))
+                                  for dependency_xml in element.findall('dependency', namespaces=nsmap))
 
         environment_xml = element.find('environment', namespaces=nsmap)
         if environment_xml is not None:
             if 'ref' in environment_xml.attrib:
-                self.environment_ref = environment_xml.attrib['ref']
+                self.environment_ref = intern(environment_xml.attrib['ref'])
             else:
-                self.environment = Environment(environment_xml)
+                self.environment = Environment(environment_xml, os.path.dirname(self.testset_file))
+
+    @property
+    def description(self):
+        xml_root = etree.parse(self.testset_file).getroot()
+        short_name = self.name.split(".", 1)[1]
+        for testcase_xml in xml_root.findall('test-case', namespaces=nsmap):
+            if testcase_xml.attrib['name'] == short_name:
+                return testcase_xml.find('description', namespaces=nsmap).text
+        return None
 
     def print(self):
         print("Test: " + self.name)
@@ -254,28 +830,32 @@ class TestCase(object):
 class Result(object):
     """This is the class that handles running individual test result checks (i.e. compares the evaluation output against the requirements), such as 'assert-eq' etc."""
 
+    __slots__ = ('type', 'value', 'children', 'vmethod')
+
     def __init__(self, element):
         # Get the internal element, and remove comment
-        self.type = etree.QName(element.tag).localname
+        self.type = intern(etree.QName(element.tag).localname)
         self.value = element.text
-        self.children = []
-        for child in element.findall("*"):
-            self.children.append(Result(child))
+        self.children = tuple(Result(child) for child in element.findall("*"))
         # if self.value is None:
         #    raise Exception("not implemented: result type %s" % self.type)
+        # The name of the method that validates this result, looked up when validating
+        # (so that results can be pickled into the catalog index)
         vmethod = self.type.replace("-", "_")
         if vmethod == 'assert':
-            self._validate = self.xassert
+            self.vmethod = 'xassert'
         elif vmethod == 'not':
-            self._validate = self.xnot
+            self.vmethod = 'xnot'
         elif hasattr(self, vmethod):
-            self._validate = getattr(self, vmethod)
+            self.vmethod = vmethod
+        else:
+            self.vmethod = '_validate'
 
     def validate(self, test_context):
         if test_context.verbose >= 5:
             print("Calling validate on Result for type %s" % self.type)
             print("Expecting value: %s" % self.value)
-        return self._validate(test_context)
+        return getattr(self, self.vmethod)(test_context)
 
     def _validate(self, test_context):
         raise Exception("Not Implemented: Result for %s" % self.type)
@@ -305,9 +885,8 @@ class Result(object):
     def assert_eq(self, test_context):
         output = create_and_run_test(test_context)
 
-        parser = XPath2Parser()
-        root_node = parser.parse(self.value)
-        context = XPathContext(root=etree.XML("<empty/>"))
+        root_node = compile_expression(self.value)
+        context = context_factory.create(EMPTY_DOCUMENT)
         result = root_node.evaluate(context)
 
         if type(output) == list and len(output) == 1:
@@ -400,22 +979,30 @@ class Result(object):
         output = create_and_run_test(test_context)
         variables = {'result': output}
 
-        parser = XPath2Parser(variables=variables)
-        root_node = parser.parse(self.value)
-        context = XPathContext(root=etree.XML("<empty/>"))
+        if RESULT_VARIABLE_RE.search(self.value):
+            root_node = compile_expression(self.value, variables=variables)
+        else:
+            root_node = compile_expression(self.value)
+        context = context_factory.create(EMPTY_DOCUMENT, variables)
         result = root_node.evaluate(context)
         return result == True
 
-    def assert_deep_eq(self, test_context):
-        output = create_and_run_test(test_context)
-        expression = "fn:deep-equal($result, (%s))" % self.value
-        variables = {'result': output}
+    def expected_sequence(self):
+        """Returns the items of the sequence the value of this result evaluates to"""
+        root_node = compile_expression("(%s)" % self.value)
+        context = context_factory.create(EMPTY_DOCUMENT)
+        return as_sequence(root_node.evaluate(context))
 
-        parser = XPath2Parser(variables=variables)
-        root_node = parser.parse(expression)
-        context = XPathContext(root=etree.XML("<empty/>"))
-        result = root_node.evaluate(context)
-        return result == True
+    def assert_deep_eq(self, test_context):
+        # Items are compared by hashable keys; sequences that can't be
+        # compared that way are compared with fn:deep-equal
+        output = as_sequence(create_and_run_test(test_context))
+        expected = self.expected_sequence()
+        keys = comparison_keys(output, expected)
+        if keys is None:
+            return deep_equal(output, expected)
+        output_keys, expected_keys = keys
+        return output_keys == expected_keys
 
     def assert_empty(self, test_context):
         output = create_and_run_test(test_context)
@@ -425,28 +1012,26 @@ class Result(object):
             return True
 
     def assert_permutation(self, test_context):
-        # Hmz, TODO: try parsing the output through elementpath
-        # If that succeeds sometimes, just raise executionerror
-        # Skip!
-        return None
-
-        output = create_and_run_test(test_context)
-        print("assert permutation")
-        print("expect: " + self.value)
-        print("get: " + str(output))
-        v = self.value
-        v = v.replace("true()", "True")
-        v = v.replace("false()", "False")
-        expect = eval("[ %s ]" % v)
-
-        expect = [str(e) for e in expect]
-        output = [str(e) for e in output]
-
-        expect.sort()
-        output.sort()
-        print("PARSED EXPECT: " + str(expect))
-        print("get: " + str(output))
-        return expect == output
+        # The output must have the same items as the expected sequence, in any
+        # order; like assert_deep_eq, but the item keys are counted
+        output = as_sequence(create_and_run_test(test_context))
+        expected = self.expected_sequence()
+        keys = comparison_keys(output, expected)
+        if keys is not None:
+            output_keys, expected_keys = keys
+            return Counter(output_keys) == Counter(expected_keys)
+
+        if len(output) != len(expected):
+            return False
+        unmatched = list(expected)
+        for item in output:
+            for position, expected_item in enumerate(unmatched):
+                if deep_equal([item], [expected_item]):
+                    del unmatched[position]
+                    break
+            else:
+                return False
+        return True
 
     def assert_serialization_error(self, test_context):
         # TODO: this currently succeeds on any error
@@ -457,9 +1042,23 @@ class Result(object):
             return True
 
     def assert_xml(self, test_context):
+        # The output and the expected fragment are compared as streams of canonical
+        # events, up to the first difference; if the expected fragment is not
+        # well-formed, the serialized output is compared to it as a string
         output = create_and_run_test(test_context)
         if output is None:
             return False
+        try:
+            expected = etree.fromstring("<fragment>%s</fragment>" % (self.value or ""))
+        except etree.XMLSyntaxError:
+            return self._assert_xml_string(output, test_context)
+
+        difference = first_xml_difference(xml_events(as_sequence(output)), fragment_events(expected))
+        if difference is not None and test_context.verbose >= 3:
+            print("assert-xml of %s differs at %s: got %s, expected %s" % ((test_context.testcase.name,) + difference))
+        return difference is None
+
+    def _assert_xml_string(self, output, test_context):
         if type(output) == list:
             parts = []
             for el in output: